@@ -2,13 +2,24 @@
 
 from django.contrib import admin
 from models import Room, Message
+from utils.polymorphism import read_queryset
 
 
-class RoomAdmin(admin.ModelAdmin):
+class ReadQuerysetAdmin(admin.ModelAdmin):
+    """Lists plain base class rows, unless subclasses of the model
+    have been registered as polymorphic
+
+    """
+    def get_queryset(self, request):
+        return read_queryset(
+                    super(ReadQuerysetAdmin, self).get_queryset(request))
+
+
+class RoomAdmin(ReadQuerysetAdmin):
     prepopulated_fields = {"slug": ("name",)}
 
 
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(ReadQuerysetAdmin):
     pass
 
 
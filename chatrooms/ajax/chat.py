@@ -1,32 +1,84 @@
 # encoding: utf-8
 
 import json
-import itertools
+import random
+import time
 from datetime import datetime, timedelta
-from collections import deque
 
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models.signals import post_delete
 from django.dispatch import receiver
+from django.http import HttpResponseForbidden, StreamingHttpResponse
 from ..utils.compat import (HttpResponse,
                         HttpResponseBadRequest)
 from django.utils.decorators import method_decorator
 
+import gevent
 from gevent.event import Event
 
-from ..models import Room
+from ..models import Room, Message
 from ..signals import chat_message_received
-from ..utils.auth import check_user_passes_test
+from ..utils import admission
+from ..utils.admission import (TooManyWaiters, check_waiters_limits,
+                               service_unavailable_if_busy)
+from ..utils.auth import (check_user_can_access_room,
+                          check_user_passes_test)
 from ..utils.decorators import ajax_user_passes_test_or_403
 from ..utils.decorators import ajax_room_login_required
 from ..utils.handlers import MessageHandlerFactory
+from ..utils.messagelog import MessageLog
+from ..utils.presence import Presence
+from ..utils.queries import get_messages_page
+from ..utils.serializers import TIME_FORMAT, encode_messages
 
 
-TIME_FORMAT = '%Y-%m-%dT%H:%M:%S:%f'
+TIMEOUT = getattr(settings, 'CHATROOMS_TIMEOUT', 3 if settings.DEBUG else 30)
 
-TIMEOUT = 30
-if settings.DEBUG:
-    TIMEOUT = 3
+MESSAGES_LOG_SIZE = getattr(settings, 'CHATROOMS_MESSAGES_LOG_SIZE', 50)
+
+ROOM_IDLE_TIME = getattr(settings, 'CHATROOMS_ROOM_IDLE_TIME', 3600)
+
+WARM_START = getattr(settings, 'CHATROOMS_WARM_START', False)
+
+WARM_START_BATCH_SIZE = getattr(settings,
+                                'CHATROOMS_WARM_START_BATCH_SIZE', 100)
+
+HISTORY_LIMIT = getattr(settings, 'CHATROOMS_HISTORY_LIMIT', 50)
+
+HISTORY_MAX_LIMIT = getattr(settings, 'CHATROOMS_HISTORY_MAX_LIMIT', 200)
+
+MULTIPLEX_MAX_ROOMS = getattr(settings, 'CHATROOMS_MULTIPLEX_MAX_ROOMS', 20)
+
+REFRESH_TIME = getattr(settings, 'CHATROOMS_REFRESH_TIME', 8)
+
+# timeouts are spread by +/- TIMEOUT_JITTER of their value
+TIMEOUT_JITTER = getattr(settings, 'CHATROOMS_TIMEOUT_JITTER', 0.2)
+
+ADAPTIVE_TIMEOUT = getattr(settings, 'CHATROOMS_ADAPTIVE_TIMEOUT', False)
+
+# number of waiters the adaptive timeouts are the shortest with,
+# unless settings.CHATROOMS_MAX_WAITERS is set
+BUSY_WAITERS = getattr(settings, 'CHATROOMS_BUSY_WAITERS', 1000)
+
+SSE_KEEPALIVE = getattr(settings, 'CHATROOMS_SSE_KEEPALIVE', 15)
+
+SSE_MAX_TIME = getattr(settings, 'CHATROOMS_SSE_MAX_TIME', 600)
+
+# milliseconds clients wait before reconnecting to the events stream
+SSE_RETRY = 3000
+
+# seconds users are kept among connected users since their latest request
+PRESENCE_TIMEOUT = getattr(settings, 'CHATROOMS_PRESENCE_TIMEOUT', 60)
+
+PRESENCE_SWEEP_INTERVAL = getattr(settings,
+                                  'CHATROOMS_PRESENCE_SWEEP_INTERVAL', 5)
+
+# number of changes of the connected users logged to send them to clients
+PRESENCE_LOG_SIZE = getattr(settings, 'CHATROOMS_PRESENCE_LOG_SIZE', 1000)
+
+# seconds users are seen again within before it counts as a change
+PRESENCE_GRANULARITY = getattr(settings, 'CHATROOMS_PRESENCE_GRANULARITY', 15)
 
 
 class ChatView(object):
@@ -46,31 +98,244 @@ class ChatView(object):
     def __init__(self):
         """
         Defines dictionary attibutes sorted by room_id
+        Room items are created on first access to the room (see
+        self.allocate_room), or for all the active rooms on the first
+        access to any room if settings.CHATROOMS_WARM_START is set
+        (see self.warm_start), and dropped by the presence_sweeper
+        greenlet when the room has been idle for
+        settings.CHATROOMS_ROOM_IDLE_TIME seconds (see
+        self.evict_idle_rooms) or when it's deleted.
         For each room:
         - new_message_events contains gevent.Event objects used by message
-          handlers to pause/restart execution and implement long polling
-        - messages stores the queue of the latest 50 messages
-        - counters contains iterators to pick up message identifiers
-        - connected_users is a dictionary holding the usernames of connected
-          users sorted by the time of their latest request
+          handlers to pause/restart execution and implement long polling;
+          each event is set once and replaced by a new one when a new
+          message is signaled, so no wake-up is lost
+        - messages stores the MessageLog of the latest messages
+          (settings.CHATROOMS_MESSAGES_LOG_SIZE, 50 by default),
+          filled with the messages read from db on room creation
+        - connected_users holds the Presence of the connected users,
+          ordered by the time of their latest request, whose version
+          counts joins, leaves and refreshes; users not seen for
+          settings.CHATROOMS_PRESENCE_TIMEOUT seconds are dropped by
+          the presence_sweeper greenlet (see self.sweep_presence)
         - new_connected_user_event contains gevent.Event objects used
           by self.notify_users_list and self.get_users_list methods to
-          implement long polling
+          implement long polling, swapped like new_message_events
+          when users join or leave
+        - responses memoizes the bodies of get_messages responses by
+          (latest_message_id, head message id), so that pollers woken
+          by the same event share them; it's cleared on new messages
+        - waiters counts the requests waiting for room events
+          (total_waiters counts them in all the rooms); requests are
+          rejected when they exceed settings.CHATROOMS_MAX_WAITERS or
+          settings.CHATROOMS_MAX_ROOM_WAITERS (see utils.admission)
+        - last_activity holds the time of the latest access to the room
+        - last_message_time holds the time of the latest message signaled
+          in the room, or of its creation (see self.get_timeout)
 
         """
+        if self._instance is not None:
+            # __init__ is called on the singleton by every ChatView() call
+            return
         self.handler = MessageHandlerFactory()
         self.new_message_events = {}
         self.messages = {}
-        self.counters = {}
+        self.responses = {}
         self.connected_users = {}
         self.new_connected_user_event = {}
-        rooms = Room.objects.all()
-        for room in rooms:
-            self.new_message_events[room.id] = Event()
-            self.messages[room.id] = deque(maxlen=50)
-            self.counters[room.id] = itertools.count(1)
-            self.connected_users[room.id] = {}
-            self.new_connected_user_event[room.id] = Event()
+        self.presence_sweeper = None
+        self.waiters = {}
+        self.total_waiters = 0
+        self.last_activity = {}
+        self.last_message_time = {}
+        self.last_eviction = time.time()
+        self.messages_log_size = MESSAGES_LOG_SIZE
+        self.presence_timeout = PRESENCE_TIMEOUT
+        self.warmed_up = False
+
+    def allocate_room(self, room_id):
+        """Creates the items of a room on its first access and
+        keeps track of the time of the latest access
+
+        """
+        now = time.time()
+        if room_id not in self.last_activity:
+            if WARM_START and not self.warmed_up:
+                self.warm_start()
+        if room_id not in self.last_activity:
+            self.create_rooms([room_id])
+        self.last_activity[room_id] = now
+
+    def create_rooms(self, room_ids):
+        """Creates the items of the given rooms, filling their
+        messages queues with their latest messages read from db
+
+        """
+        now = time.time()
+        for room_id in room_ids:
+            self.new_message_events[room_id] = Event()
+            self.messages[room_id] = MessageLog(self.messages_log_size)
+            self.connected_users[room_id] = Presence(
+                            PRESENCE_LOG_SIZE, PRESENCE_GRANULARITY)
+            self.new_connected_user_event[room_id] = Event()
+            self.waiters[room_id] = 0
+            self.last_activity[room_id] = now
+            self.last_message_time[room_id] = now
+        self.handler.load_latest_messages(self, room_ids)
+        self.start_presence_sweeper()
+
+    def warm_start(self, room_ids=None, batch_size=WARM_START_BATCH_SIZE):
+        """
+        Creates the items of the given rooms, by default the ones which
+        received messages in the latest settings.CHATROOMS_ROOM_IDLE_TIME
+        seconds, loading their latest messages by one query
+        per batch_size rooms
+
+        """
+        self.warmed_up = True
+        if room_ids is None:
+            since = datetime.now() - timedelta(seconds=ROOM_IDLE_TIME)
+            room_ids = Message.objects.filter(
+                            date__gte=since).values_list(
+                            'room', flat=True).distinct()
+        room_ids = [room_id for room_id in room_ids
+                    if room_id not in self.last_activity]
+        for start in xrange(0, len(room_ids), batch_size):
+            self.create_rooms(room_ids[start:start + batch_size])
+
+    def free_room(self, room_id):
+        """Drops the items of a room, waking up its waiters """
+        self.last_activity.pop(room_id, None)
+        self.last_message_time.pop(room_id, None)
+        self.messages.pop(room_id, None)
+        self.responses.pop(room_id, None)
+        self.connected_users.pop(room_id, None)
+        self.waiters.pop(room_id, None)
+        for events in (self.new_message_events,
+                       self.new_connected_user_event):
+            event = events.pop(room_id, None)
+            if event is not None:
+                event.set()
+
+    def start_presence_sweeper(self, interval=PRESENCE_SWEEP_INTERVAL):
+        """Spawns the presence_sweeper greenlet, unless it's running,
+        which sweeps the connected users every interval seconds, and
+        evicts the idle rooms every settings.CHATROOMS_ROOM_IDLE_TIME
+        seconds
+
+        """
+        def sweep():
+            while True:
+                gevent.sleep(interval)
+                self.sweep_presence()
+                if time.time() - self.last_eviction > ROOM_IDLE_TIME:
+                    self.evict_idle_rooms()
+
+        if self.presence_sweeper is None or self.presence_sweeper.dead:
+            self.presence_sweeper = gevent.spawn(sweep)
+
+    def sweep_presence(self, max_age=None):
+        """Drops the connected users not seen in the latest max_age
+        seconds (self.presence_timeout by default), signaling
+        new_connected_user_event of their rooms
+
+        """
+        if max_age is None:
+            max_age = self.presence_timeout
+        now = time.time()
+        for room_id, presence in self.connected_users.items():
+            if presence.expire(max_age, now):
+                # the event is swapped without allocating the room,
+                # which would count as an access to it
+                event = self.new_connected_user_event[room_id]
+                self.new_connected_user_event[room_id] = Event()
+                event.set()
+
+    def evict_idle_rooms(self, idle_time=ROOM_IDLE_TIME):
+        """Drops the items of rooms with no waiters which haven't
+        been accessed for idle_time seconds
+
+        """
+        now = time.time()
+        self.last_eviction = now
+        for room_id, last_activity in self.last_activity.items():
+            if (now - last_activity > idle_time
+                    and not self.waiters.get(room_id)):
+                self.free_room(room_id)
+
+    def wait_for_room_event(self, room_id, event, timeout):
+        """Waits for an event of a room, counting the waiter among
+        the room waiters
+        Returns True if the event was set, False on timeout
+
+        """
+        return bool(self.wait_for_room_events(room_id, [event], timeout))
+
+    def wait_for_room_events(self, room_id, events, timeout):
+        """Waits for any of the given events of a room, counting
+        the waiter among the room waiters
+        Returns the list of the events set, empty on timeout
+
+        """
+        return self.wait_for_rooms_events(
+                    [(room_id, event) for event in events], timeout)
+
+    def wait_for_rooms_events(self, room_events, timeout):
+        """Waits for any of the events of a list of (room_id, event)
+        tuples, counting the waiter among the waiters of each room
+        Returns the list of the events set, empty on timeout
+        Raises TooManyWaiters if the waiter exceeds the limits of
+        waiting requests
+
+        """
+        room_ids = set(room_id for room_id, event in room_events)
+        for room_id in room_ids:
+            self.allocate_room(room_id)
+        check_waiters_limits(
+            self.total_waiters,
+            dict((room_id, self.waiters[room_id]) for room_id in room_ids))
+        for room_id in room_ids:
+            self.waiters[room_id] += 1
+        self.total_waiters += 1
+        try:
+            return gevent.wait([event for room_id, event in room_events],
+                               timeout=timeout, count=1)
+        finally:
+            self.total_waiters -= 1
+            now = time.time()
+            for room_id in room_ids:
+                if room_id in self.waiters:
+                    self.waiters[room_id] -= 1
+                    self.last_activity[room_id] = now
+
+    def get_timeout(self, room_ids, base=TIMEOUT):
+        """
+        Returns the seconds a request waiting for events of the given
+        rooms waits at most, base seconds spread by a random jitter of
+        +/- settings.CHATROOMS_TIMEOUT_JITTER, so that clients which
+        connected together don't time out and reconnect together.
+        If settings.CHATROOMS_ADAPTIVE_TIMEOUT is set, base is:
+        1 - doubled if none of the rooms received messages in the
+            latest 4 * base seconds, as their clients seldom wake up
+        2 - shortened down to a quarter as the number of waiters
+            grows to settings.CHATROOMS_MAX_WAITERS (or
+            settings.CHATROOMS_BUSY_WAITERS), so that waiters
+            turn over before they're rejected
+
+        """
+        timeout = base
+        if ADAPTIVE_TIMEOUT:
+            # 1
+            now = time.time()
+            if all(now - self.last_message_time.get(room_id, now) > base * 4
+                   for room_id in room_ids):
+                timeout *= 2
+            # 2
+            max_waiters = admission.MAX_WAITERS or BUSY_WAITERS
+            load = min(float(self.total_waiters) / max_waiters, 1)
+            timeout *= 1 - 0.75 * load
+        return timeout * random.uniform(1 - TIMEOUT_JITTER,
+                                        1 + TIMEOUT_JITTER)
 
     def get_username(self, request):
         """Returns username if user is authenticated, guest name otherwise """
@@ -82,33 +347,114 @@ class ChatView(object):
         return username
 
     def signal_new_message_event(self, room_id):
-        """Signals new_message_event given a room_id """
-        self.new_message_events[room_id].set()
-        self.new_message_events[room_id].clear()
+        """Signals new_message_event given a room_id
+        Memoized responses of the room are dropped, as they
+        don't include the new message
 
-    def wait_for_new_message(self, room_id, timeout=TIMEOUT):
-        """Waits for new_message_event given a room_id """
-        self.new_message_events[room_id].wait(timeout)
+        """
+        self.allocate_room(room_id)
+        self.responses.pop(room_id, None)
+        self.last_message_time[room_id] = time.time()
+        event = self.new_message_events[room_id]
+        self.new_message_events[room_id] = Event()
+        event.set()
+
+    def signal_new_connected_user_event(self, room_id):
+        """Signals new_connected_user_event given a room_id """
+        self.allocate_room(room_id)
+        event = self.new_connected_user_event[room_id]
+        self.new_connected_user_event[room_id] = Event()
+        event.set()
+
+    def wait_for_new_message(self, room_id, latest_msg_id=None,
+                             timeout=TIMEOUT):
+        """Waits for new_message_event given a room_id, unless
+        the room has already received messages following latest_msg_id
+        Returns True if there are new messages, False on timeout
+
+        """
+        self.allocate_room(room_id)
+        # the event is taken before checking the latest message id,
+        # which handlers may read from db or other processes: a message
+        # signaled in the meantime sets it
+        event = self.new_message_events[room_id]
+        if latest_msg_id is not None:
+            head_id = self.handler.get_latest_message_id(self, room_id)
+            if head_id > latest_msg_id:
+                return True
+        return self.wait_for_room_event(room_id, event, timeout)
+
+    def wait_for_new_messages(self, rooms, timeout=TIMEOUT):
+        """Waits for new_message_event of any of the given rooms,
+        a dictionary of latest message ids by room id, unless a room
+        has already received messages following its latest message id
+        Returns True if there are new messages, False on timeout
+
+        """
+        room_events = []
+        for room_id, latest_msg_id in rooms.iteritems():
+            self.allocate_room(room_id)
+            room_events.append((room_id, self.new_message_events[room_id]))
+            head_id = self.handler.get_latest_message_id(self, room_id)
+            if head_id > latest_msg_id:
+                return True
+        return bool(self.wait_for_rooms_events(room_events, timeout))
 
     def get_messages_queue(self, room_id):
         """Returns the message queue given a room_id """
+        self.allocate_room(room_id)
         return self.messages[room_id]
 
-    def get_next_message_id(self, room_id):
-        """Returns the next message identifier given a room_id """
-        return self.counters[room_id].next()
+    def update_connected_user(self, room_id, username):
+        """Keeps username among the connected users of a room,
+        signaling new_connected_user_event if the user joined, and
+        calls the handle_presence hook of the handler if the version
+        of the connected users changed
+        Returns True if the user joined
+
+        """
+        presence = self.get_connected_users(room_id)
+        version = presence.version
+        joined = presence.touch(username)
+        if presence.version != version:
+            self.handler.handle_presence(self, room_id, username)
+        if joined:
+            self.signal_new_connected_user_event(room_id)
+        return joined
 
     def get_connected_users(self, room_id):
         """Returns the connected users given a room_id"""
+        self.allocate_room(room_id)
         return self.connected_users[room_id]
 
+    def encode_messages_response(self, room_id, latest_msg_id, messages):
+        """
+        Returns the JSON encoded list of messages following latest_msg_id,
+        memoized by (room_id, latest_msg_id, head message id): pollers
+        woken by the same event mostly send the same latest_msg_id, and
+        share the same response body.
+
+        """
+        if not messages:
+            return encode_messages(messages, latest_msg_id)
+        key = (latest_msg_id, messages[-1][0])
+        room_responses = self.responses.setdefault(room_id, {})
+        body = room_responses.get(key)
+        if body is None:
+            body = encode_messages(messages, latest_msg_id)
+            room_responses[key] = body
+        return body
+
+    @method_decorator(service_unavailable_if_busy)
     @method_decorator(ajax_room_login_required)
     @method_decorator(ajax_user_passes_test_or_403(check_user_passes_test))
     def get_messages(self, request):
         """Handles ajax requests for messages
         Requests must contain room_id and latest_id
         Delegates MessageHandler.retrieve_message method to return the list
-        of messages
+        of messages, which is encoded joining the JSON fragments cached
+        along with messages, if any, and memoized for the pollers
+        sending the same latest_message_id
 
         """
         try:
@@ -120,19 +466,115 @@ class ChatView(object):
             "Expected a GET request with 'room_id' and 'latest_message_id' "
             "parameters")
 
+        timeout = self.get_timeout([room_id])
         messages = self.handler.retrieve_messages(
-                        self, room_id, latest_msg_id)
-
-        to_jsonify = [
-            {"message_id": msg_id,
-             "username": message.username,
-             "date": message.date.strftime(TIME_FORMAT),
-             "content": message.content}
-            for msg_id, message in messages
-            if msg_id > latest_msg_id
-        ]
-        return HttpResponse(json.dumps(to_jsonify),
-                            mimetype="application/json")
+                        self, room_id, latest_msg_id, timeout=timeout)
+
+        response = HttpResponse(
+                    self.encode_messages_response(
+                        room_id, latest_msg_id, messages),
+                    mimetype="application/json")
+        response['X-Chatrooms-Timeout'] = '%.1f' % timeout
+        return response
+
+    @method_decorator(service_unavailable_if_busy)
+    def get_rooms_messages(self, request):
+        """Handles ajax requests for messages of several rooms
+        Requests must contain rooms, a JSON object holding the
+        latest_message_id of each room id, for at most
+        settings.CHATROOMS_MULTIPLEX_MAX_ROOMS rooms.
+        Access to each room is checked once, as view decorators do
+        for single room requests: the rooms the user can't access are
+        returned as denied, and a 403 response is given if the user
+        can't access any of them.
+        Waits for new messages of any room, and returns the new
+        messages of each room which received them as messages
+
+        """
+        try:
+            rooms = dict(
+                (int(room_id), int(latest_msg_id))
+                for room_id, latest_msg_id
+                in json.loads(request.GET['rooms']).iteritems())
+            if not 0 < len(rooms) <= MULTIPLEX_MAX_ROOMS:
+                raise ValueError
+        except:
+            return HttpResponseBadRequest(
+            "Parameters missing or bad parameters. "
+            "Expected a GET request with a 'rooms' parameter holding "
+            "a JSON object of latest message ids by room id")
+
+        denied = sorted(
+            room_id for room_id in rooms
+            if not check_user_can_access_room(request, request.user, room_id))
+        if len(denied) == len(rooms):
+            return HttpResponseForbidden("Access denied")
+        for room_id in denied:
+            del rooms[room_id]
+
+        timeout = self.get_timeout(list(rooms))
+        self.wait_for_new_messages(rooms, timeout)
+        bodies = []
+        for room_id, latest_msg_id in sorted(rooms.iteritems()):
+            if room_id not in self.last_activity:
+                # the room has been dropped while waiting
+                continue
+            if self.handler.get_latest_message_id(
+                    self, room_id) <= latest_msg_id:
+                continue
+            messages = self.handler.retrieve_messages(
+                            self, room_id, latest_msg_id)
+            if messages:
+                bodies.append('"%d": %s' % (
+                    room_id, self.encode_messages_response(
+                                room_id, latest_msg_id, messages)))
+        response = HttpResponse(
+                    '{"messages": {%s}, "denied": %s}' % (
+                        ', '.join(bodies), json.dumps(denied)),
+                    mimetype="application/json")
+        response['X-Chatrooms-Timeout'] = '%.1f' % timeout
+        return response
+
+    @method_decorator(ajax_room_login_required)
+    @method_decorator(ajax_user_passes_test_or_403(check_user_passes_test))
+    def get_history(self, request):
+        """Handles ajax requests for pages of the room messages history
+        Requests must contain room_id, and may contain either before_id
+        or after_id, and limit (settings.CHATROOMS_HISTORY_LIMIT by
+        default, at most settings.CHATROOMS_HISTORY_MAX_LIMIT).
+        Returns the messages preceding before_id or following after_id,
+        or the latest messages if neither is given, sorted by id,
+        along with a has_more flag telling whether further messages
+        can be requested in the same direction
+
+        """
+        try:
+            room_id = int(request.GET['room_id'])
+            before_id = request.GET.get('before_id')
+            after_id = request.GET.get('after_id')
+            if before_id is not None and after_id is not None:
+                raise ValueError
+            if before_id is not None:
+                before_id = int(before_id)
+            if after_id is not None:
+                after_id = int(after_id)
+            limit = int(request.GET.get('limit', HISTORY_LIMIT))
+            if limit < 1:
+                raise ValueError
+        except:
+            return HttpResponseBadRequest(
+            "Parameters missing or bad parameters. "
+            "Expected a GET request with 'room_id' and either 'before_id' "
+            "or 'after_id' parameters, and a positive 'limit'")
+
+        records, has_more = get_messages_page(
+                        room_id, before_id=before_id, after_id=after_id,
+                        limit=min(limit, HISTORY_MAX_LIMIT))
+        messages = [(record.id, record) for record in records]
+        return HttpResponse(
+                    '{"messages": %s, "has_more": %s}' % (
+                        encode_messages(messages), json.dumps(has_more)),
+                    mimetype="application/json")
 
     @method_decorator(ajax_room_login_required)
     @method_decorator(ajax_user_passes_test_or_403(check_user_passes_test))
@@ -173,44 +615,233 @@ class ChatView(object):
             return HttpResponseBadRequest(
             "Parameters missing or bad parameters"
             "Expected a POST request with 'room_id'")
-        username = self.get_username(request)
-        date = datetime.today()
-        self.connected_users[room_id].update({username: date})
-        self.new_connected_user_event[room_id].set()
-        self.new_connected_user_event[room_id].clear()
+        self.update_connected_user(room_id, self.get_username(request))
         return HttpResponse('Connected')
 
+    @method_decorator(service_unavailable_if_busy)
     @method_decorator(ajax_room_login_required)
     @method_decorator(ajax_user_passes_test_or_403(check_user_passes_test))
     def get_users_list(self, request):
-        """Dumps the list of connected users """
-        REFRESH_TIME = 8
+        """Dumps the list of connected users
+        Requests may contain the users_version the client got, to get
+        only the changes following it (see self.encode_users_list),
+        at once if users joined or left since then
+
+        """
         try:
             room_id = int(request.GET['room_id'])
+            users_version = request.GET.get('users_version')
+            if users_version is not None:
+                users_version = int(users_version)
         except:
             return HttpResponseBadRequest(
             "Parameters missing or bad parameters"
-            "Expected a POST request with 'room_id'")
-        username = self.get_username(request)
-        self.connected_users[room_id].update({
-                                username: datetime.today()
-                            })
-        self.new_connected_user_event[room_id].wait(REFRESH_TIME)
-
-        # clean connected_users dictionary of disconnected users
-        self._clean_connected_users(room_id)
-        json_users = [
-            {"username": _user,
-             "date": _date.strftime(TIME_FORMAT)}
-            for _user, _date in self.connected_users[room_id].iteritems()
-        ]
-        json_response = {
-            "now": datetime.today().strftime(TIME_FORMAT),
-            "users": json_users,
-            "refresh": str(REFRESH_TIME),
-        }
-        return HttpResponse(json.dumps(json_response),
-                            mimetype='application/json')
+            "Expected a GET request with 'room_id'")
+        self.update_connected_user(room_id, self.get_username(request))
+        presence = self.get_connected_users(room_id)
+        refresh = self.get_timeout([room_id], REFRESH_TIME)
+        if (users_version is None or
+                presence.members_version <= users_version
+                <= presence.version):
+            self.wait_for_room_event(
+                    room_id, self.new_connected_user_event[room_id],
+                    refresh)
+
+        return HttpResponse(
+                    self.encode_users_list(room_id, refresh, users_version),
+                    mimetype='application/json')
+
+    def encode_users_list(self, room_id, refresh=REFRESH_TIME,
+                          users_version=None):
+        """Returns the JSON encoded connected users, along with their
+        version and the seconds clients refresh them within:
+        the changes following users_version, if given and still logged,
+        as changes, the list of connected users otherwise, as users
+        Both are encoded once per version of the connected users
+
+        """
+        presence = self.get_connected_users(room_id)
+        changes = None
+        if users_version is not None:
+            changes = presence.encode_changes(users_version)
+        if changes is None:
+            users = '"users": %s' % presence.encode()
+        else:
+            users = '"changes": %s' % changes
+        return '{"now": "%s", "version": %d, %s, "refresh": "%.1f"}' % (
+                    datetime.today().strftime(TIME_FORMAT),
+                    presence.version, users, refresh)
+
+    @method_decorator(service_unavailable_if_busy)
+    @method_decorator(ajax_room_login_required)
+    @method_decorator(ajax_user_passes_test_or_403(check_user_passes_test))
+    def stream_events(self, request):
+        """Handles Server-Sent Events requests
+        Requests must contain room_id and latest_message_id, which is
+        overridden by the Last-Event-ID header sent by reconnecting
+        clients, so that they resume from the latest message they got.
+        Streams the new messages of the room and the list of connected
+        users as they change (see self.generate_events)
+
+        """
+        try:
+            room_id = int(request.GET['room_id'])
+            latest_msg_id = int(request.META.get('HTTP_LAST_EVENT_ID') or
+                                request.GET['latest_message_id'])
+        except:
+            return HttpResponseBadRequest(
+            "Parameters missing or bad parameters. "
+            "Expected a GET request with 'room_id' and 'latest_message_id' "
+            "parameters")
+
+        # streams wait for room events: they're rejected
+        # before they start if there are too many waiters
+        self.allocate_room(room_id)
+        check_waiters_limits(self.total_waiters,
+                             {room_id: self.waiters[room_id]})
+        response = StreamingHttpResponse(
+                    self.generate_events(
+                        room_id, latest_msg_id, self.get_username(request),
+                        self.get_timeout([room_id], SSE_MAX_TIME)),
+                    content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # asks nginx not to buffer the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def generate_events(self, room_id, latest_msg_id, username,
+                        max_time=SSE_MAX_TIME):
+        """
+        Yields the Server-Sent Events of a room, for at most max_time
+        seconds (settings.CHATROOMS_SSE_MAX_TIME) or until the room
+        is dropped; clients then reconnect by themselves:
+        1 - a "messages" event for the messages following latest_msg_id,
+            whose id is the id of the latest of them
+        2 - a "users" event for the list of connected users on start,
+            and for its changes following the version last sent (see
+            self.encode_users_list); username is kept among connected
+            users while the stream is open
+        3 - a comment every settings.CHATROOMS_SSE_KEEPALIVE seconds
+            with no events, keeping the connection open
+        The stream is closed if it exceeds the limits of waiting
+        requests, so that the client reconnects later
+
+        """
+        deadline = time.time() + max_time
+        yield 'retry: %d\n\n' % SSE_RETRY
+        users_version = None
+        while True:
+            # streams of busy rooms may never wait: username is kept
+            # among connected users on each round
+            self.update_connected_user(room_id, username)
+            # events are taken before checking for messages and users:
+            # changes in the meantime set them
+            message_event = self.new_message_events[room_id]
+            users_event = self.new_connected_user_event[room_id]
+            # 1
+            if self.handler.get_latest_message_id(
+                    self, room_id) > latest_msg_id:
+                messages = self.handler.retrieve_messages(
+                                self, room_id, latest_msg_id)
+                if messages:
+                    body = self.encode_messages_response(
+                                room_id, latest_msg_id, messages)
+                    latest_msg_id = messages[-1][0]
+                    yield 'id: %d\nevent: messages\ndata: %s\n\n' % (
+                                latest_msg_id, body)
+            # 2
+            version = self.get_connected_users(room_id).version
+            if version != users_version:
+                body = self.encode_users_list(
+                                room_id, users_version=users_version)
+                users_version = version
+                yield 'event: users\ndata: %s\n\n' % body
+
+            timeout = min(SSE_KEEPALIVE, deadline - time.time())
+            if timeout <= 0:
+                return
+            try:
+                events = self.wait_for_room_events(
+                            room_id, [message_event, users_event], timeout)
+            except TooManyWaiters:
+                return
+            if room_id not in self.last_activity:
+                # the room has been dropped
+                return
+            if not events:
+                # 3
+                yield ': keepalive\n\n'
+
+    @method_decorator(service_unavailable_if_busy)
+    @method_decorator(ajax_room_login_required)
+    @method_decorator(ajax_user_passes_test_or_403(check_user_passes_test))
+    def sync(self, request):
+        """Handles ajax requests for both messages and connected users,
+        replacing get_messages, get_users_list and notify_users_list
+        requests
+        Requests must contain room_id, latest_message_id and the
+        users_version the client got (-1 on the first request)
+        1 - keeps the user among the connected users, signaling
+            new_connected_user_event if the user wasn't connected
+        2 - waits for either new_message_event or
+            new_connected_user_event, at most REFRESH_TIME seconds
+            (see self.get_timeout), unless there are new messages or
+            users joined or left since users_version
+        3 - returns the messages following latest_message_id, and
+            the changes of the connected users following users_version,
+            or their list if the client is too far behind (see
+            self.encode_users_list), unless they didn't change
+
+        """
+        try:
+            room_id = int(request.GET['room_id'])
+            latest_msg_id = int(request.GET['latest_message_id'])
+            users_version = int(request.GET.get('users_version', -1))
+        except:
+            return HttpResponseBadRequest(
+            "Parameters missing or bad parameters. "
+            "Expected a GET request with 'room_id', 'latest_message_id' "
+            "and 'users_version' parameters")
+
+        # 1
+        self.update_connected_user(room_id, self.get_username(request))
+        presence = self.get_connected_users(room_id)
+
+        # 2
+        message_event = self.new_message_events[room_id]
+        users_event = self.new_connected_user_event[room_id]
+        new_messages = self.handler.get_latest_message_id(
+                            self, room_id) > latest_msg_id
+        refresh = self.get_timeout([room_id], REFRESH_TIME)
+        if (not new_messages and presence.members_version
+                <= users_version <= presence.version):
+            self.wait_for_room_events(
+                    room_id, [message_event, users_event], refresh)
+            if room_id not in self.last_activity:
+                # the room has been dropped while waiting: handlers
+                # would allocate it again
+                return HttpResponse('{"messages": [], "users": null}',
+                                    mimetype="application/json")
+            new_messages = self.handler.get_latest_message_id(
+                                self, room_id) > latest_msg_id
+
+        # 3
+        messages_body = '[]'
+        if new_messages:
+            messages = self.handler.retrieve_messages(
+                            self, room_id, latest_msg_id)
+            messages_body = self.encode_messages_response(
+                            room_id, latest_msg_id, messages)
+        users_body = 'null'
+        if presence.version != users_version:
+            users_body = self.encode_users_list(
+                            room_id, refresh, users_version)
+        response = HttpResponse(
+                    '{"messages": %s, "users": %s}' % (
+                        messages_body, users_body),
+                    mimetype="application/json")
+        response['X-Chatrooms-Timeout'] = '%.1f' % refresh
+        return response
 
     @method_decorator(ajax_room_login_required)
     @method_decorator(ajax_user_passes_test_or_403(check_user_passes_test))
@@ -224,29 +855,27 @@ class ChatView(object):
         response = {"id": latest_msg_id}
         return HttpResponse(json.dumps(response), mimetype="application/json")
 
-    def _clean_connected_users(self, room_id, seconds=60):
-        """Remove from connected users dictionary users not seen
-        for seconds
+    @method_decorator(staff_member_required)
+    def get_waiters(self, request):
+        """Dumps the number of requests waiting for room events,
+        in total and by room id, along with their limits
 
         """
-        now = datetime.today()
-        for usr, date in self.connected_users[room_id].items():
-            if (now - timedelta(seconds=seconds)) > date:
-                self.connected_users[room_id].pop(usr)
+        response = {
+            "waiters": self.total_waiters,
+            "rooms": dict((str(room_id), waiters) for room_id, waiters
+                          in self.waiters.iteritems() if waiters),
+            "max_waiters": admission.MAX_WAITERS,
+            "max_room_waiters": admission.MAX_ROOM_WAITERS,
+        }
+        return HttpResponse(json.dumps(response), mimetype="application/json")
 
 
-@receiver(post_save, sender=Room)
-def create_events_for_new_room(sender, **kwargs):
-    """Creates an entry in Chat dictionary attributes
-    when a new room is created
+@receiver(post_delete, sender=Room)
+def free_deleted_room(sender, **kwargs):
+    """Drops the entries of Chat dictionary attributes
+    when a room is deleted, waking up its waiters
 
     """
-    if kwargs.get('created'):
-        instance = kwargs.get('instance')
-        room_id = instance.id
-        chatview = ChatView()
-        chatview.new_message_events[room_id] = Event()
-        chatview.messages[room_id] = deque(maxlen=50)
-        chatview.counters[room_id] = itertools.count(1)
-        chatview.connected_users[room_id] = {}
-        chatview.new_connected_user_event[room_id] = Event()
+    instance = kwargs.get('instance')
+    ChatView().free_room(instance.id)
@@ -0,0 +1,429 @@
+#encoding=utf8
+"""
+Benchmarks for the chat hot paths.
+
+Each benchmark is a function registered by the ``benchmark`` decorator
+which returns a list of result rows (dictionaries).
+They can be run by the ``chatrooms_benchmark`` management command.
+
+"""
+import gc
+import json
+import os
+import resource
+import sys
+import traceback
+import types
+from datetime import datetime
+from timeit import default_timer
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from .models import Room, Message
+from .utils.auth import check_user_passes_test
+from .utils.decorators import (ajax_room_login_required,
+                               ajax_user_passes_test_or_403,
+                               room_check_access)
+from .utils import admission
+from .utils.messagelog import MessageLog, MessageRecord
+from .utils.polymorphism import polymorphic_registry, read_queryset
+from .utils.queries import get_messages_page
+from .utils.rooms import room_cache
+from .utils.serializers import TIME_FORMAT, encode_messages
+
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Registers the decorated function as the benchmark called name """
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def timed(func, repeat=3):
+    """Returns the best time of repeat calls to func, in milliseconds """
+    best = None
+    for _ in xrange(repeat):
+        start = default_timer()
+        func()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000
+
+
+def count_queries(func):
+    """Returns the number of queries run by a call to func """
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    return len(queries)
+
+
+def deep_sizeof(objects):
+    """
+    Returns the size in bytes of the given objects and of all the objects
+    they refer to, counting shared objects once.
+    Types, modules and functions aren't counted.
+
+    """
+    skipped = (type, types.ModuleType, types.FunctionType,
+               types.BuiltinFunctionType)
+    seen = set()
+    size = 0
+    pending = list(objects)
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, skipped):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+def run_in_fork(func):
+    """
+    Returns the result of func, a JSON serializable value, computed
+    in a forked process, so that the peak resident size measured by
+    func starts from the memory in use at the fork instead of the
+    peak reached by earlier benchmarks
+    Raises RuntimeError if func fails in the forked process
+
+    """
+    import gevent
+
+    read_fd, write_fd = os.pipe()
+    pid = gevent.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            with os.fdopen(write_fd, 'w') as output:
+                json.dump(func(), output)
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as output:
+        data = output.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('benchmark process %d failed' % pid)
+    return json.loads(data)
+
+
+class BenchmarkMessage(object):
+    """Stand-in for a Message instance, with the fields sent to clients """
+    def __init__(self, username, date, content):
+        self.username = username
+        self.date = date
+        self.content = content
+
+
+@benchmark('serialization')
+def serialization_benchmark(room_sizes=(1, 10, 100, 500, 2000),
+                            new_messages=5):
+    """
+    Compares the time spent answering every poller of a room woken
+    by new messages, serializing the messages for each request versus
+    joining the JSON fragments cached in the room MessageLog.
+
+    """
+    log = MessageLog(50)
+    for msg_id in xrange(1, 51):
+        log.append((msg_id, BenchmarkMessage(
+            'user%d' % (msg_id % 7), datetime.now(), 'message %d' % msg_id)))
+    latest_msg_id = log.head_id - new_messages
+
+    def serialize_each_time(pollers):
+        for _ in xrange(pollers):
+            json.dumps([
+                {"message_id": msg_id,
+                 "username": message.username,
+                 "date": message.date.strftime(TIME_FORMAT),
+                 "content": message.content}
+                for msg_id, message in log
+                if msg_id > latest_msg_id
+            ])
+
+    def join_cached_fragments(pollers):
+        for _ in xrange(pollers):
+            encode_messages(log.since(latest_msg_id), latest_msg_id)
+
+    results = []
+    for pollers in room_sizes:
+        before = timed(lambda: serialize_each_time(pollers))
+        after = timed(lambda: join_cached_fragments(pollers))
+        results.append({
+            'pollers': pollers,
+            'serialize_ms': round(before, 3),
+            'cached_ms': round(after, 3),
+            'speedup': round(before / after, 1) if after else None,
+        })
+    return results
+
+
+@benchmark('memory')
+def memory_benchmark(buffer_sizes=(50, 500, 5000)):
+    """
+    Compares the bytes per buffered message of rooms message logs
+    holding saved Message instances versus MessageRecord objects.
+    Objects shared by the messages (room, user) are counted once.
+
+    """
+    room = Room(id=1, name='Benchmark room', slug='benchmark-room')
+    user = User(id=1, username='john')
+    results = []
+    for size in buffer_sizes:
+        messages = []
+        for msg_id in xrange(1, size + 1):
+            message = Message(id=msg_id, room=room, user=user,
+                              username=user.username, date=datetime.now(),
+                              content='message %d' % msg_id)
+            # as after Message.save()
+            message.pre_save_polymorphic()
+            message._state.adding = False
+            message._state.db = 'default'
+            messages.append(message)
+        records = [MessageRecord.from_message(message)
+                   for message in messages]
+        before = deep_sizeof(messages)
+        after = deep_sizeof(records)
+        results.append({
+            'messages': size,
+            'instance_bytes': before // size,
+            'record_bytes': after // size,
+        })
+    return results
+
+
+@benchmark('queries')
+def queries_benchmark(messages_count=50):
+    """
+    Counts the queries run by the access-check decorators and by
+    get_messages requests, on the first request to a room and on the
+    following ones, and compares polymorphic and plain reads of the
+    room messages.
+    A room with messages_count messages is created for the benchmark
+    and deleted afterwards.
+
+    """
+    from .ajax.chat import ChatView
+
+    room = Room.objects.create(name='Queries benchmark room',
+                               slug='queries-benchmark-room',
+                               allow_anonymous_access=True)
+    try:
+        message_ids = [Message.objects.create(room=room, username='john',
+                                              date=datetime.now(),
+                                              content='message %d' % i).pk
+                       for i in xrange(messages_count)]
+        # the client already got half of the messages
+        latest_msg_id = message_ids[messages_count // 2]
+        factory = RequestFactory()
+
+        def ajax_request():
+            request = factory.get('/', {'room_id': room.id,
+                                        'latest_message_id': latest_msg_id},
+                                  HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            request.user = AnonymousUser()
+            return request
+
+        ajax_view = ajax_room_login_required(
+                        ajax_user_passes_test_or_403(check_user_passes_test)(
+                            lambda request: HttpResponse()))
+        page_view = room_check_access(lambda request, slug: HttpResponse())
+        chatview = ChatView()
+
+        def get_messages():
+            chatview.get_messages(ajax_request())
+
+        def page_request():
+            request = factory.get('/')
+            request.user = User(id=1)
+            page_view(request, slug=room.slug)
+
+        room_cache.clear()
+        chatview.free_room(room.id)
+        results = [
+            {'path': 'ajax decorators, cold',
+             'queries': count_queries(lambda: ajax_view(ajax_request()))},
+            {'path': 'ajax decorators, warm',
+             'queries': count_queries(lambda: ajax_view(ajax_request()))},
+            {'path': 'room_check_access, warm',
+             'queries': count_queries(page_request)},
+        ]
+        chatview.free_room(room.id)
+        results.extend([
+            {'path': 'get_messages, cold room',
+             'queries': count_queries(get_messages)},
+            {'path': 'get_messages, warm room',
+             'queries': count_queries(get_messages)},
+        ])
+        chatview.free_room(room.id)
+
+        messages = Message.objects.filter(room=room)
+        polymorphic_ms = timed(lambda: list(messages.all()))
+        plain_ms = timed(lambda: list(read_queryset(messages.all())))
+        results.extend([
+            {'path': 'room messages, polymorphic',
+             'queries': count_queries(lambda: list(messages.all())),
+             'ms': round(polymorphic_ms, 3)},
+            {'path': 'room messages, %s' % (
+                'polymorphic (registered)'
+                if polymorphic_registry.needs_resolution(Message)
+                else 'plain'),
+             'queries': count_queries(
+                 lambda: list(read_queryset(messages.all()))),
+             'ms': round(plain_ms, 3)},
+        ])
+        return results
+    finally:
+        room.delete()
+
+
+@benchmark('history')
+def history_benchmark(rows=2000000, rooms=20, limit=50,
+                      depths=(0, 1000, 10000, 90000), batch_size=10000):
+    """
+    Compares the time spent reading a history page of limit messages
+    of a room, depths messages back from its latest message, by keyset
+    pagination (see utils.queries.get_messages_page) versus OFFSET
+    pagination.
+    The messages table is filled with rows messages spread over rooms,
+    inserted by raw queries and deleted afterwards.
+
+    """
+    qn = connection.ops.quote_name
+    table = qn(Message._meta.db_table)
+    created_rooms = [
+        Room.objects.create(name='History benchmark room %d' % index,
+                            slug='history-benchmark-room-%d' % index)
+        for index in xrange(rooms)]
+    room_ids = [room.id for room in created_rooms]
+    ctype_id = ContentType.objects.get_for_model(Message).id
+    insert = (
+        "INSERT INTO %s (%s, %s, %s, %s, %s) VALUES (%%s, %%s, %%s, %%s, %%s)"
+        % (table, qn('room_id'), qn('username'), qn('date'), qn('content'),
+           qn('polymorphic_ctype_id')))
+    cursor = connection.cursor()
+    try:
+        now = datetime.now()
+        for start in xrange(0, rows, batch_size):
+            with transaction.atomic():
+                cursor.executemany(insert, [
+                    (room_ids[row % rooms], 'user%d' % (row % 7), now,
+                     'message %d' % row, ctype_id)
+                    for row in xrange(start, min(start + batch_size, rows))])
+
+        room_id = room_ids[0]
+        messages = Message.objects.filter(room=room_id).order_by(
+                        '-pk').values_list('id', 'username', 'date', 'content')
+        results = []
+        for depth in depths:
+            if depth:
+                # id of the oldest message of the previous page
+                before_id = messages[depth - 1:depth][0][0]
+            else:
+                before_id = None
+            keyset_ms = timed(lambda: get_messages_page(
+                                room_id, before_id=before_id, limit=limit))
+            offset_ms = timed(lambda: [
+                MessageRecord(*fields)
+                for fields in messages[depth:depth + limit]])
+            results.append({
+                'rows': rows,
+                'depth': depth,
+                'keyset_ms': round(keyset_ms, 3),
+                'offset_ms': round(offset_ms, 3),
+            })
+        return results
+    finally:
+        cursor.execute(
+            "DELETE FROM %s WHERE %s IN (%s)" % (
+                table, qn('room_id'), ', '.join(['%s'] * len(room_ids))),
+            room_ids)
+        for room in created_rooms:
+            room.delete()
+
+
+@benchmark('waiters')
+def waiters_benchmark(waiters_counts=(1000, 10000, 50000)):
+    """
+    Measures the capacity of a process for requests waiting for room
+    events and their wake-up latency: waiters_counts greenlets wait
+    for a message of a room, then a message is signaled.
+    Reports the time spent parking the waiters, the memory they take
+    (growth of the process peak resident size, which is an upper
+    bound) and the time from the signal to the wake-up of the median
+    and of the last waiter.
+    Each count is measured in a forked process, so that its peak
+    resident size doesn't start from the peak of the previous count.
+    settings.CHATROOMS_MAX_WAITERS and settings.CHATROOMS_MAX_ROOM_WAITERS
+    are lifted during the benchmark.
+    A room is created for the benchmark and deleted afterwards.
+
+    """
+    import gevent
+    from .ajax.chat import ChatView
+
+    def measure(count):
+        woken = []
+        failed = []
+
+        def wait():
+            try:
+                chatview.wait_for_new_message(room.id, timeout=60)
+            except Exception as exc:
+                failed.append(exc)
+            else:
+                woken.append(default_timer())
+
+        gc.collect()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = default_timer()
+        greenlets = [gevent.spawn(wait) for _ in xrange(count)]
+        while chatview.waiters[room.id] < count:
+            if failed:
+                raise failed[0]
+            gevent.sleep(0)
+        park_ms = (default_timer() - start) * 1000
+        # ru_maxrss is in kilobytes on Linux
+        rss_growth = (resource.getrusage(
+                        resource.RUSAGE_SELF).ru_maxrss - rss_before) * 1024
+
+        signaled = default_timer()
+        chatview.signal_new_message_event(room.id)
+        gevent.joinall(greenlets)
+        latencies = sorted(wake - signaled for wake in woken)
+        return {
+            'waiters': count,
+            'park_ms': round(park_ms, 1),
+            'bytes_per_waiter': rss_growth // count,
+            'median_wakeup_ms': round(
+                latencies[len(latencies) // 2] * 1000, 3),
+            'last_wakeup_ms': round(latencies[-1] * 1000, 3),
+        }
+
+    limits = admission.MAX_WAITERS, admission.MAX_ROOM_WAITERS
+    admission.MAX_WAITERS = admission.MAX_ROOM_WAITERS = None
+    room = Room.objects.create(name='Waiters benchmark room',
+                               slug='waiters-benchmark-room')
+    chatview = ChatView()
+    try:
+        chatview.allocate_room(room.id)
+        return [run_in_fork(lambda: measure(count))
+                for count in waiters_counts]
+    finally:
+        room.delete()
+        admission.MAX_WAITERS, admission.MAX_ROOM_WAITERS = limits
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatrooms.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    args = '[benchmark ...]'
+    help = ("Runs the given chatrooms benchmarks, all of them if none "
+            "is given. Available benchmarks: %s" % ', '.join(
+                sorted(BENCHMARKS)))
+
+    def handle(self, *args, **options):
+        """Runs the benchmarks and prints their results as rows """
+        names = args or sorted(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError("Unknown benchmark: %s" % name)
+        for name in names:
+            self.stdout.write("%s\n" % name)
+            for row in BENCHMARKS[name]():
+                self.stdout.write("    %s\n" % ', '.join(
+                    "%s=%s" % (key, row[key]) for key in sorted(row)))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from chatrooms.utils.broker_handlers import BROKER_SOCKET, Broker
+
+
+class Command(BaseCommand):
+    args = '[socket path]'
+    help = ("Runs the broker relaying the chatrooms events between the "
+            "worker processes of the host, listening to the given UNIX "
+            "socket, settings.CHATROOMS_BROKER_SOCKET by default")
+
+    def handle(self, *args, **options):
+        """Runs the broker until it's interrupted """
+        path = args[0] if args else BROKER_SOCKET
+        self.stdout.write("chatrooms broker listening to %s\n" % path)
+        Broker(path).serve_forever()
@@ -33,3 +33,7 @@ class Message(PolymorphicModel):
     date = models.DateTimeField()
     room = models.ForeignKey(Room)
     content = models.CharField(max_length=5000)
+
+    class Meta:
+        # history pages are read by (room, id) ranges
+        index_together = [('room', 'id')]
@@ -4,6 +4,15 @@
 $(function(){
     var Context = getContext();
     var latest_message_id;
+    var users_version = -1;
+    // last seen dates of the connected users by username
+    var connected_users = {};
+    // seconds the server waits at most, read from X-Chatrooms-Timeout
+    var poll_timeout = 0;
+    // whether a stream has been opened once, and seconds before
+    // opening again a stream closed by the browser
+    var stream_opened = false;
+    var stream_retry_delay = 5;
 
     $.ajax({
             url: "/chat/get_latest_msg_id/",
@@ -103,77 +112,115 @@ $(function(){
         return to_append.join("");
     };
 
-    var chatGetMessages = function(){
+    var showMessages = function(data){
+        var chatText = getChatText(data)
+        $('#chatText').append(chatText);
+        $("#chatText").attr({
+            scrollTop: $("#chatText").attr("scrollHeight")});
+    };
+
+    var showUsersList = function(data){
+        /* updates the connected users by either the whole list or
+        the changes following users_version, then shows them all:
+        the server drops the users who aren't connected anymore */
+        var i;
+        if (data.users){
+            connected_users = {};
+            for (i = 0; i < data.users.length; i++){
+                connected_users[data.users[i].username] = data.users[i].date;
+            }
+        } else {
+            var changed = data.changes.changed;
+            for (i = 0; i < changed.length; i++){
+                connected_users[changed[i].username] = changed[i].date;
+            }
+            for (i = 0; i < data.changes.left.length; i++){
+                delete connected_users[data.changes.left[i]];
+            }
+        }
+        users_version = data.version;
+        $('#connectedUsersList').empty();
+        for (var username in connected_users){
+            if (Context.username == username){
+                $('#connectedUsersList').append(
+                    '<li>You</li>');
+            } else{
+                $('#connectedUsersList').append(
+                    '<li>'+ username + '</li>');}
+        }
+    };
+
+    var chatSync = function(){
+        /* waits for both messages and connected users by one request */
         $.ajax({
-            url: "/chat/get_messages/",
+            url: "/chat/sync/",
             cache: false,
             dataType: "json",
             data: {'room_id': Context.room_id,
-                   'latest_message_id': latest_message_id},
+                   'latest_message_id': latest_message_id,
+                   'users_version': users_version},
             type: "GET",
-            success: function(data) {
-                var chatText = getChatText(data)
-                $('#chatText').append(chatText);
-                $("#chatText").attr({
-                    scrollTop: $("#chatText").attr("scrollHeight")});
-                window.setTimeout(chatGetMessages, 0);
+            timeout: poll_timeout ? (poll_timeout + 10) * 1000 : 0,
+            success: function(data, textStatus, jqXHR) {
+                poll_timeout = parseFloat(
+                    jqXHR.getResponseHeader('X-Chatrooms-Timeout')) || 0;
+                showMessages(data.messages);
+                if (data.users){
+                    showUsersList(data.users);
+                }
+                window.setTimeout(chatSync, 0);
             },
             error: function(jqXHR, textStatus, errorThrown){
                 if (textStatus === 'timeout'){
-                    window.setTimeout(chatGetMessages, 0);
+                    window.setTimeout(chatSync, 0);
+                }
+                else if (jqXHR.status === 503){
+                    // the server is busy: retries later
+                    var retryAfter = parseInt(
+                        jqXHR.getResponseHeader('Retry-After'), 10) || 5;
+                    window.setTimeout(chatSync, retryAfter * 1000);
                 }
             }});
     };
-    var notifyConnection = function(){
-        $.ajax({
-            url: "/chat/notify_users_list/",
-            cache: false,
-            data: {'room_id': Context.room_id},
-            type: 'POST',
-            success: function(data){
-                // window.setTimeout(usersListGet, 0);
-            }
-            
-        });
+
+    var startLongPolling = function(){
+        window.setTimeout(chatSync, 0);
     };
-    
-    var usersListGet = function(){
-        $.ajax({
-            url: "/chat/get_users_list/",
-            cache: false,
-            dataType: "json",
-            data: {'room_id': Context.room_id},
-            type: "GET",
-            success: function(data){
-                $('#connectedUsersList').empty();
-                var now = parseDateTime(data.now);
-                var date = new Date(now.year, now.month, now.day,
-                                    now.hour, now.minute, now.second);
-                $('#connectedUsersList').empty();
-                date = date.valueOf();
-                var users = data.users;
-                for (var i = 0; i < users.length; i++){
-                    var userdate = parseDateTime(users[i].date);
-                    var userJsDate = new Date(
-                            userdate.year,
-                            userdate.month,
-                            userdate.day,
-                            userdate.hour,
-                            userdate.minute,
-                            userdate.second);
-                    userJsDate = userJsDate.valueOf();
-                    if (date - userJsDate < (data.refresh * 2) * 1000){
-                        if (Context.username == users[i].username){
-                            $('#connectedUsersList').append(
-                                '<li>You</li>');    
-                        } else{
-                            $('#connectedUsersList').append(
-                                '<li>'+ users[i].username + '</li>');}
-                    }
-                }
-                window.setTimeout(usersListGet, 0);
+
+    var chatStreamEvents = function(){
+        /* receives messages and users list by Server-Sent Events;
+        the browser reconnects by itself sending the Last-Event-ID header,
+        so that the stream resumes from the latest message received.
+        Falls back to long polling if the stream can't be opened.
+        Browsers close the stream for good when a reconnection gets an
+        error response, e.g. 503 when the server is busy: it's opened
+        again after a delay, doubled on each failure up to a minute */
+        var source = new EventSource(
+            "/chat/stream_events/?room_id=" + Context.room_id +
+            "&latest_message_id=" + latest_message_id);
+        source.onopen = function(){
+            stream_opened = true;
+            stream_retry_delay = 5;
+        };
+        source.addEventListener('messages', function(event){
+            showMessages($.parseJSON(event.data));
+        }, false);
+        source.addEventListener('users', function(event){
+            showUsersList($.parseJSON(event.data));
+        }, false);
+        source.onerror = function(){
+            if (source.readyState !== EventSource.CLOSED){
+                // the browser reconnects by itself
+                return;
             }
-        });
+            source.close();
+            if (!stream_opened){
+                startLongPolling();
+                return;
+            }
+            window.setTimeout(chatStreamEvents, stream_retry_delay * 1000);
+            stream_retry_delay = Math.min(stream_retry_delay * 2, 60);
+        };
     };
 
     $('#chatSendButton').bind("click", chatSendAction);
@@ -194,7 +241,11 @@ $(function(){
     });
     
     
-    window.setTimeout(chatGetMessages, 0);
-    window.setTimeout(usersListGet, 0);
-    window.setTimeout(notifyConnection, 0);
+    // Context.transport may be set to "longpoll" to disable
+    // Server-Sent Events
+    if (window.EventSource && Context.transport !== "longpoll"){
+        chatStreamEvents();
+    } else {
+        startLongPolling();
+    }
 });
@@ -1,17 +1,74 @@
 import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import urlparse
+from datetime import datetime
+from unittest import skipUnless
+
+import gevent
+from gevent import socket
 
 from django.contrib.auth.models import User
-from django.test import TestCase
-from django.test.client import Client
+from django.core.cache import get_cache
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
 
+from chatrooms.ajax import chat
 from chatrooms.ajax.chat import ChatView
-from chatrooms.models import Room
-from chatrooms.utils.auth import get_login_url
+from chatrooms.models import Room, Message
+from chatrooms.utils import admission, queries
+from chatrooms.utils.auth import authorization_cache, get_login_url
+from chatrooms.utils.broker_handlers import BrokerMessageHandler
+from chatrooms.utils.cache_handlers import (CACHE_POLL_INTERVAL,
+                                            CacheMessageHandler)
+from chatrooms.utils.examples import check_user_is_subscribed
+from chatrooms.utils.handlers import (MessageHandler,
+                                     WriteBehindMessageHandler)
+from chatrooms.utils.messagelog import MessageLog, MessageRecord
+from chatrooms.utils.presence import Presence
+from chatrooms.utils.polymorphism import (polymorphic_registry,
+                                          read_queryset)
+from chatrooms.utils.rooms import RoomCache, room_cache
+from chatrooms.utils.serializers import TIME_FORMAT, encode_messages
+
+try:
+    import fakeredis
+    from chatrooms.utils import redis_handlers
+    from chatrooms.utils.redis_handlers import RedisMessageHandler
+except ImportError:
+    fakeredis = None
+
+try:
+    from celery import Celery
+    from chatrooms.utils.celery_handlers import CeleryMessageHandler
+except ImportError:
+    Celery = None
 
 
-class ChatroomsTest(TestCase):
+class ChatViewTestMixin(object):
+    """Drops the rooms items of the ChatView singleton and the cached
+    rooms before each test, as room ids are reused by the test database
+
+    """
     def setUp(self):
+        room_cache.clear()
+        authorization_cache.clear()
+        chatview = ChatView()
+        for room_id in chatview.last_activity.keys():
+            chatview.free_room(room_id)
+
+
+class ChatViewTestCase(ChatViewTestMixin, TestCase):
+    pass
+
+
+class ChatroomsTest(ChatViewTestCase):
+    def setUp(self):
+        super(ChatroomsTest, self).setUp()
         # creates a user
         self.username = 'john'
         self.userpwd = 'johnpasswd'
@@ -24,28 +81,61 @@ class ChatroomsTest(TestCase):
 
     def test_chatview_attributes(self):
         """Asserts new items are added to ChatView instance
-        when a new room is created, and these items are removed
-        when a room is deleted
+        when a room is first accessed, and these items are removed
+        when the room is deleted, waking up its waiters
 
         """
         new_room = Room(name="New room",
                         slug="new-room")
         new_room.save()
+        room_id = new_room.id
         chatview = ChatView()
-        self.assertIn(new_room.id, chatview.new_message_events)
-        self.assertIn(new_room.id, chatview.messages)
-        self.assertIn(new_room.id, chatview.connected_users)
-        self.assertIn(new_room.id, chatview.counters)
-        self.assertIn(new_room.id, chatview.new_connected_user_event)
+        self.assertNotIn(room_id, chatview.messages)
+
+        chatview.get_messages_queue(room_id)
+        self.assertIn(room_id, chatview.new_message_events)
+        self.assertIn(room_id, chatview.messages)
+        self.assertIn(room_id, chatview.connected_users)
+        self.assertIn(room_id, chatview.new_connected_user_event)
 
-        # works without a post_delete handler: somewhere the Django models
-        #  collector gets rid of these items (awkward, not documented feat)
+        waiter = gevent.spawn(chatview.wait_for_new_message, room_id, -1, 5)
+        poller = gevent.spawn(chatview.handler.retrieve_messages,
+                              chatview, room_id, -1, timeout=5)
+        gevent.sleep(0)
+        self.assertEquals(chatview.waiters[room_id], 2)
         new_room.delete()
-        self.assertNotIn(new_room.id, chatview.new_message_events)
-        self.assertNotIn(new_room.id, chatview.messages)
-        self.assertNotIn(new_room.id, chatview.connected_users)
-        self.assertNotIn(new_room.id, chatview.counters)
-        self.assertNotIn(new_room.id, chatview.new_connected_user_event)
+        self.assertTrue(waiter.get(timeout=1))
+        # woken requests don't allocate the dropped room again
+        self.assertEquals(poller.get(timeout=1), [])
+        self.assertNotIn(room_id, chatview.last_activity)
+        self.assertNotIn(room_id, chatview.new_message_events)
+        self.assertNotIn(room_id, chatview.messages)
+        self.assertNotIn(room_id, chatview.connected_users)
+        self.assertNotIn(room_id, chatview.new_connected_user_event)
+
+    def test_evict_idle_rooms(self):
+        """Asserts idle rooms items are dropped unless there are
+        requests waiting on the room
+
+        """
+        chatview = ChatView()
+        idle_room, waited_room = Room(name="Idle"), Room(name="Waited")
+        idle_room.save()
+        waited_room.save()
+        chatview.get_messages_queue(idle_room.id)
+        chatview.get_messages_queue(waited_room.id)
+        waiter = gevent.spawn(chatview.wait_for_new_message,
+                              waited_room.id, -1, 5)
+        gevent.sleep(0)
+
+        chatview.evict_idle_rooms(idle_time=0)
+        self.assertNotIn(idle_room.id, chatview.messages)
+        self.assertIn(waited_room.id, chatview.messages)
+
+        chatview.signal_new_message_event(waited_room.id)
+        self.assertTrue(waiter.get(timeout=1))
+        chatview.evict_idle_rooms(idle_time=0)
+        self.assertNotIn(waited_room.id, chatview.messages)
 
     def test_anonymous_access(self):
         anon_room = Room(
@@ -125,9 +215,12 @@ class ChatroomsTest(TestCase):
                                                 room.id, last_msg_id),
                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEquals(response.status_code, 200)
+        self.assertTrue(
+            0 < float(response['X-Chatrooms-Timeout']) <= chat.TIMEOUT * 1.2)
         json_response = json.loads(response.content)
 
-        expected_json = [{u'message_id': 1,
+        message_id = Message.objects.get(room=room).pk
+        expected_json = [{u'message_id': message_id,
                           u'username': u'john',
                           u'date': timestamp,
                           u'content': u'ABCD', }]
@@ -137,4 +230,1174 @@ class ChatroomsTest(TestCase):
         response = client.get('/chat/get_latest_msg_id/?room_id=%d' % room.id)
         json_response = json.loads(response.content)
         last_msg_id = json_response['id']
-        self.assertEquals(last_msg_id, 1)
+        self.assertEquals(last_msg_id, message_id)
+
+    def test_stream_events(self):
+        """Asserts messages and connected users are streamed as
+        Server-Sent Events, resuming from the Last-Event-ID header
+
+        """
+        client = Client()
+        client.login(username=self.username, password=self.userpwd)
+        room = Room(name="Streaming room", slug="streaming-room")
+        room.save()
+        chatview = ChatView()
+        message = chatview.handler.handle_received_message(
+                        chatview, room.id, 'paul', 'Hello', datetime.now())
+
+        response = client.get('/chat/stream_events/',
+                              {'room_id': room.id, 'latest_message_id': -1})
+        self.assertEquals(response['Content-Type'], 'text/event-stream')
+        events = iter(response.streaming_content)
+        self.assertTrue(next(events).startswith('retry: '))
+        event = next(events)
+        self.assertTrue(event.startswith(
+            'id: %d\nevent: messages\ndata: ' % message.pk))
+        self.assertEquals(
+            json.loads(event.split('data: ', 1)[1])[0]['content'], 'Hello')
+        event = next(events)
+        self.assertTrue(event.startswith('event: users\ndata: '))
+        self.assertEquals(
+            [user['username'] for user in
+             json.loads(event.split('data: ', 1)[1])['users']], ['john'])
+
+        new_message = chatview.handler.handle_received_message(
+                        chatview, room.id, 'paul', 'Again', datetime.now())
+        response = client.get('/chat/stream_events/',
+                              {'room_id': room.id, 'latest_message_id': -1},
+                              HTTP_LAST_EVENT_ID=str(message.pk))
+        events = iter(response.streaming_content)
+        next(events)
+        event = next(events)
+        self.assertTrue(event.startswith('id: %d\n' % new_message.pk))
+        self.assertEquals(
+            [msg['content'] for msg
+             in json.loads(event.split('data: ', 1)[1])], ['Again'])
+
+    def test_get_rooms_messages(self):
+        """Asserts a request for several rooms returns the new messages
+        of the rooms which received them, and the denied rooms
+
+        """
+        client = Client()
+        client.login(username=self.username, password=self.userpwd)
+        quiet_room = Room(name="Quiet room", slug="quiet-room")
+        quiet_room.save()
+        busy_room = Room(name="Busy room", slug="busy-room")
+        busy_room.save()
+        chatview = ChatView()
+        message = chatview.handler.handle_received_message(
+                        chatview, busy_room.id, 'paul', 'Hi', datetime.now())
+
+        rooms = {quiet_room.id: -1, busy_room.id: -1, busy_room.id + 1: -1}
+        response = client.get('/chat/get_rooms_messages/',
+                              {'rooms': json.dumps(rooms)},
+                              HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEquals(response.status_code, 200)
+        json_response = json.loads(response.content)
+        self.assertEquals(json_response['denied'], [busy_room.id + 1])
+        self.assertEquals(json_response['messages'].keys(),
+                          [str(busy_room.id)])
+        self.assertEquals(
+            [msg['message_id'] for msg
+             in json_response['messages'][str(busy_room.id)]],
+            [message.pk])
+
+        response = client.get('/chat/get_rooms_messages/',
+                              {'rooms': json.dumps({busy_room.id + 1: -1})},
+                              HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEquals(response.status_code, 403)
+
+    def test_sync(self):
+        """Asserts sync requests return the new messages, and the
+        connected users list when the client doesn't have its version
+
+        """
+        client = Client()
+        client.login(username=self.username, password=self.userpwd)
+        room = Room(name="Sync room", slug="sync-room")
+        room.save()
+
+        def sync(latest_msg_id, users_version):
+            response = client.get('/chat/sync/', {
+                                    'room_id': room.id,
+                                    'latest_message_id': latest_msg_id,
+                                    'users_version': users_version},
+                                  HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEquals(response.status_code, 200)
+            return json.loads(response.content)
+
+        json_response = sync(-1, -1)
+        self.assertEquals(json_response['messages'], [])
+        users = json_response['users']
+        self.assertEquals(
+            [user['username'] for user in users['users']], ['john'])
+
+        chatview = ChatView()
+        message = chatview.handler.handle_received_message(
+                        chatview, room.id, 'paul', 'Hi', datetime.now())
+        json_response = sync(-1, users['version'])
+        self.assertEquals(
+            [msg['message_id'] for msg in json_response['messages']],
+            [message.pk])
+        self.assertEquals(json_response['users'], None)
+
+        self.assertTrue(chatview.update_connected_user(room.id, 'paul'))
+        json_response = sync(message.pk, users['version'])
+        self.assertEquals(json_response['messages'], [])
+        changes = json_response['users']['changes']
+        self.assertEquals(
+            [user['username'] for user in changes['changed']], ['paul'])
+        self.assertEquals(changes['left'], [])
+
+    def test_get_history(self):
+        """Asserts history pages are read backwards and forwards
+        from a message id
+
+        """
+        client = Client()
+        client.login(username=self.username, password=self.userpwd)
+        room = Room(name="History room", slug="history-room")
+        room.save()
+        ids = [Message.objects.create(room=room, username='john',
+                                      date=datetime.now(),
+                                      content='message %d' % i).pk
+               for i in range(5)]
+
+        def get_history(**params):
+            params['room_id'] = room.id
+            response = client.get('/chat/get_history/', params,
+                                  HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEquals(response.status_code, 200)
+            page = json.loads(response.content)
+            return ([msg['message_id'] for msg in page['messages']],
+                    page['has_more'])
+
+        self.assertEquals(get_history(limit=2), (ids[3:], True))
+        self.assertEquals(get_history(limit=2, before_id=ids[3]),
+                          (ids[1:3], True))
+        self.assertEquals(get_history(limit=2, before_id=ids[1]),
+                          (ids[:1], False))
+        self.assertEquals(get_history(after_id=ids[0], limit=3),
+                          (ids[1:4], True))
+        self.assertEquals(get_history(after_id=ids[2]), (ids[3:], False))
+
+        response = client.get('/chat/get_history/',
+                              {'room_id': room.id, 'after_id': ids[0],
+                               'before_id': ids[4]},
+                              HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEquals(response.status_code, 400)
+
+
+class MessageLogTest(ChatViewTestCase):
+    def test_since_and_overflow(self):
+        log = MessageLog(capacity=3)
+        self.assertEquals(log.since(-1), [])
+        self.assertEquals(log.head_id, None)
+        messages = dict(
+            (msg_id, Message(username='john', date=datetime.now(),
+                             content='message %d' % msg_id))
+            for msg_id in range(1, 6))
+        for msg_id in range(1, 6):
+            log.append((msg_id, messages[msg_id]))
+
+        # the two oldest messages have been dropped
+        self.assertEquals(len(log), 3)
+        self.assertEquals(log.oldest_id, 3)
+        self.assertEquals(log.head_id, 5)
+        self.assertEquals(log.last_dropped_id, 2)
+        self.assertEquals(log.since(3), [(4, messages[4]), (5, messages[5])])
+        self.assertEquals(log.since(5), [])
+        self.assertTrue(log.holds_messages_since(2))
+        self.assertFalse(log.holds_messages_since(1))
+
+        # messages saved concurrently are inserted at their place
+        log.append((4, messages[4]))
+        log.append((2, messages[2]))
+        self.assertEquals([msg_id for msg_id, msg in log], [3, 4, 5])
+        log = MessageLog(capacity=3)
+        for msg_id in (1, 2, 4, 5, 3):
+            log.append((msg_id, messages[msg_id]))
+        self.assertEquals([msg_id for msg_id, msg in log], [3, 4, 5])
+        self.assertEquals(log.last_dropped_id, 2)
+        self.assertEquals(log.since(3), [(4, messages[4]), (5, messages[5])])
+
+    def test_cached_fragments(self):
+        """Asserts the JSON built from cached fragments is the same
+        as the one built serializing each message
+
+        """
+        log = MessageLog(capacity=3)
+        for msg_id in range(1, 5):
+            log.append((msg_id, Message(username='john',
+                                        date=datetime.now(),
+                                        content=u'message \xe0 %d' % msg_id)))
+        batch = log.since(1)
+        self.assertEquals(
+            encode_messages(batch, 1),
+            encode_messages(list(batch), 1))
+        self.assertEquals(
+            [msg['message_id'] for msg in json.loads(encode_messages(batch))],
+            [2, 3, 4])
+
+    def test_retrieve_dropped_messages(self):
+        room = Room(name="Log room", slug="log-room")
+        room.save()
+        chatview = ChatView()
+        chatview.allocate_room(room.id)
+        chatview.messages[room.id] = MessageLog(capacity=2)
+        handler = MessageHandler()
+        ids = [handler.handle_received_message(
+                chatview, room.id, 'john', 'message %d' % i,
+                datetime.now()).pk
+               for i in range(5)]
+
+        # messages 0 to 2 are read from db, one log capacity at a time
+        messages = handler.retrieve_dropped_messages(chatview, room.id, -1)
+        self.assertEquals(
+            [(msg_id, msg.content) for msg_id, msg in messages],
+            [(ids[0], 'message 0'), (ids[1], 'message 1')])
+        messages = handler.retrieve_dropped_messages(
+                                            chatview, room.id, ids[1])
+        self.assertEquals(
+            [(msg_id, msg.content) for msg_id, msg in messages],
+            [(ids[2], 'message 2'), (ids[3], 'message 3'),
+             (ids[4], 'message 4')])
+
+    def test_load_latest_messages(self):
+        """Asserts rooms messages queues are filled with the latest
+        messages read from db, by one query per batch of rooms
+
+        """
+        rooms = [Room(name="Warm room %d" % i, slug="warm-room-%d" % i)
+                 for i in range(3)]
+        ids = {}
+        for room in rooms:
+            room.save()
+            ids[room.id] = [Message.objects.create(
+                                room=room, username='john',
+                                date=datetime.now(), content='message').pk
+                            for i in range(60)]
+        chatview = ChatView()
+        with self.assertNumQueries(3):
+            chatview.warm_start(batch_size=2)
+        handler = MessageHandler()
+        for room in rooms:
+            messages_queue = chatview.get_messages_queue(room.id)
+            self.assertEquals([msg_id for msg_id, msg in messages_queue],
+                              ids[room.id][-chatview.messages_log_size:])
+            self.assertEquals(
+                handler.get_latest_message_id(chatview, room.id),
+                ids[room.id][-1])
+
+        # older messages are read from db
+        messages = handler.retrieve_messages(chatview, rooms[0].id, -1)
+        self.assertEquals([msg_id for msg_id, msg in messages],
+                          ids[rooms[0].id])
+
+        # without window functions, messages are read by room
+        window_functions = queries.WINDOW_FUNCTIONS
+        queries.WINDOW_FUNCTIONS = False
+        try:
+            room_ids = [room.id for room in rooms]
+            with self.assertNumQueries(3):
+                latest_messages = queries.get_latest_messages_by_room(
+                                                            room_ids, 50)
+        finally:
+            queries.WINDOW_FUNCTIONS = window_functions
+        for room in rooms:
+            self.assertEquals(
+                [record.id for record in latest_messages[room.id]],
+                ids[room.id][-50:])
+
+    def test_message_records(self):
+        """Asserts the default handler buffers immutable MessageRecord
+        copies of saved messages
+
+        """
+        room = Room(name="Records room", slug="records-room")
+        room.save()
+        chatview = ChatView()
+        message = MessageHandler().handle_received_message(
+            chatview, room.id, 'john', 'message', datetime.now())
+        msg_id, record = chatview.get_messages_queue(room.id)[-1]
+        self.assertTrue(isinstance(record, MessageRecord))
+        self.assertEquals(
+            (record.pk, record.username, record.date, record.content),
+            (message.pk, message.username, message.date, message.content))
+        self.assertRaises(AttributeError, setattr, record, 'content', 'x')
+
+
+class ResponsesMemoTest(ChatViewTestCase):
+    def test_memoized_response(self):
+        """Asserts pollers sending the same latest_message_id share
+        the same response body until a new message is appended
+
+        """
+        room = Room(name="Memo room", slug="memo-room")
+        room.save()
+        chatview = ChatView()
+        handler = MessageHandler()
+        for i in range(1, 4):
+            handler.handle_received_message(
+                chatview, room.id, 'john', 'message %d' % i, datetime.now())
+
+        messages = chatview.get_messages_queue(room.id).since(1)
+        body = chatview.encode_messages_response(room.id, 1, messages)
+        self.assertTrue(body is chatview.encode_messages_response(
+                                    room.id, 1, messages))
+        self.assertEquals(
+            [msg['message_id'] for msg in json.loads(body)], [2, 3])
+
+        handler.handle_received_message(
+            chatview, room.id, 'john', 'message 4', datetime.now())
+        self.assertNotIn(room.id, chatview.responses)
+        messages = chatview.get_messages_queue(room.id).since(1)
+        body = chatview.encode_messages_response(room.id, 1, messages)
+        self.assertEquals(
+            [msg['message_id'] for msg in json.loads(body)], [2, 3, 4])
+
+
+class WaitForNewMessageTest(ChatViewTestCase):
+    def setUp(self):
+        super(WaitForNewMessageTest, self).setUp()
+        self.room = Room(name="Wait room", slug="wait-room")
+        self.room.save()
+        self.chatview = ChatView()
+        self.handler = MessageHandler()
+        self.handler.handle_received_message(
+            self.chatview, self.room.id, 'john', 'message', datetime.now())
+
+    def test_returns_at_once_if_behind(self):
+        """Asserts a client behind the room head doesn't wait, even if
+        the message arrived before it started polling
+
+        """
+        started = time.time()
+        self.assertTrue(
+            self.chatview.wait_for_new_message(self.room.id, 0, timeout=5))
+        self.assertTrue(time.time() - started < 1)
+
+    def test_waits_if_up_to_date(self):
+        head_id = self.handler.get_latest_message_id(
+                                        self.chatview, self.room.id)
+        self.assertFalse(self.chatview.wait_for_new_message(
+                                        self.room.id, head_id, timeout=0.1))
+
+        waiter = gevent.spawn(self.chatview.wait_for_new_message,
+                              self.room.id, head_id, 5)
+        gevent.sleep(0)
+        self.handler.handle_received_message(
+            self.chatview, self.room.id, 'john', 'message', datetime.now())
+        self.assertTrue(waiter.get(timeout=1))
+
+    def test_waits_for_any_room(self):
+        """Asserts a waiter for several rooms is woken by a message
+        to any of them, and counted among the waiters of each room
+
+        """
+        other_room = Room(name="Other wait room", slug="other-wait-room")
+        other_room.save()
+        head_id = self.handler.get_latest_message_id(
+                                        self.chatview, self.room.id)
+        rooms = {self.room.id: head_id, other_room.id: -1}
+        self.chatview.allocate_room(other_room.id)
+        waiter = gevent.spawn(self.chatview.wait_for_new_messages, rooms, 5)
+        gevent.sleep(0)
+        self.assertEquals(self.chatview.waiters[self.room.id], 1)
+        self.assertEquals(self.chatview.waiters[other_room.id], 1)
+        self.handler.handle_received_message(
+            self.chatview, other_room.id, 'john', 'message', datetime.now())
+        self.assertTrue(waiter.get(timeout=1))
+        self.assertEquals(self.chatview.waiters[self.room.id], 0)
+
+
+@skipUnless(fakeredis, "redis and fakeredis packages are required")
+class RedisMessageHandlerTest(ChatViewTestCase):
+    def setUp(self):
+        super(RedisMessageHandlerTest, self).setUp()
+        self.chatview = ChatView()
+        self.handler = RedisMessageHandler(
+                            client=fakeredis.FakeStrictRedis())
+        self.handler.client.flushall()
+        self.default_handler = self.chatview.handler
+        self.chatview.handler = self.handler
+        self.handler.start_subscriber(self.chatview)
+        gevent.sleep(0)
+
+    def tearDown(self):
+        self.chatview.handler = self.default_handler
+        self.handler.subscriber.kill()
+
+    def test_room_channels(self):
+        """Asserts a message wakes up only the requests waiting
+        on its room, through the process subscriber
+
+        """
+        room = Room(name="Redis room", slug="redis-room")
+        other_room = Room(name="Other redis room", slug="other-redis-room")
+        room.save()
+        other_room.save()
+        for room_id in (room.id, other_room.id):
+            self.chatview.allocate_room(room_id)
+        waiter = gevent.spawn(self.chatview.wait_for_new_message,
+                              room.id, None, 5)
+        other_waiter = gevent.spawn(self.chatview.wait_for_new_message,
+                                    other_room.id, None, 0.5)
+        gevent.sleep(0)
+
+        self.handler.handle_received_message(
+            self.chatview, room.id, 'john', 'message', datetime.now())
+        self.assertTrue(waiter.get(timeout=2))
+        self.assertFalse(other_waiter.get(timeout=2))
+
+        # a client behind the room head gets messages at once
+        messages = self.handler.retrieve_messages(self.chatview, room.id, -1)
+        self.assertEquals([msg.content for msg_id, msg in messages],
+                          ['message'])
+
+    def test_latest_messages_from_redis(self):
+        """Asserts requests are answered from redis, reading from db
+        only messages older than the ones kept by redis
+
+        """
+        room = Room(name="Redis room", slug="redis-room")
+        room.save()
+        ids = [Message.objects.create(
+                    room=room, username='john', date=datetime.now(),
+                    content='message %d' % i).pk
+               for i in range(3)]
+        messages_size = redis_handlers.REDIS_MESSAGES_SIZE
+        redis_handlers.REDIS_MESSAGES_SIZE = 3
+        try:
+            self.assertEquals(
+                self.handler.get_latest_message_id(self.chatview, room.id),
+                ids[-1])
+            for i in range(3, 5):
+                self.handler.handle_received_message(
+                    self.chatview, room.id, 'john', 'message %d' % i,
+                    datetime.now())
+            ids = list(Message.objects.filter(
+                            room=room).values_list('id', flat=True))
+            with self.assertNumQueries(0):
+                self.assertEquals(self.handler.get_latest_message_id(
+                                    self.chatview, room.id), ids[-1])
+                messages = self.handler.retrieve_messages(
+                                    self.chatview, room.id, ids[2])
+                self.assertEquals(
+                    [(msg_id, msg.content) for msg_id, msg in messages],
+                    [(ids[3], 'message 3'), (ids[4], 'message 4')])
+            messages = self.handler.retrieve_messages(
+                                    self.chatview, room.id, -1)
+            self.assertEquals(
+                [(msg_id, msg.content) for msg_id, msg in messages],
+                [(msg_id, 'message %d' % i) for i, msg_id in enumerate(ids)])
+            self.assertEquals(
+                json.loads(encode_messages(messages))[-1]['content'],
+                'message 4')
+        finally:
+            redis_handlers.REDIS_MESSAGES_SIZE = messages_size
+
+
+@skipUnless(Celery, "celery package is required")
+class CeleryMessageHandlerTest(ChatViewTestCase):
+    def setUp(self):
+        super(CeleryMessageHandlerTest, self).setUp()
+        self.chatview = ChatView()
+        self.handler = CeleryMessageHandler(
+                            app=Celery(broker='memory://', fixups=[]))
+        self.default_handler = self.chatview.handler
+        self.chatview.handler = self.handler
+        self.handler.start_receiver(self.chatview)
+        gevent.sleep(0.1)
+
+    def tearDown(self):
+        self.chatview.handler = self.default_handler
+        self.handler.receiver.kill()
+
+    def test_shared_receiver(self):
+        """Asserts message events wake up the requests waiting on their
+        room and keep the latest message id without reading db
+
+        """
+        room = Room(name="Celery room", slug="celery-room")
+        room.save()
+        self.assertEquals(
+            self.handler.get_latest_message_id(self.chatview, room.id), -1)
+        self.chatview.allocate_room(room.id)
+        waiter = gevent.spawn(self.chatview.wait_for_new_message,
+                              room.id, None, 5)
+        gevent.sleep(0)
+
+        # an event sent by another process
+        self.handler.dispatcher.send(type='chatrooms-message',
+                                     room_id=room.id, message_id=1000)
+        self.assertTrue(waiter.get(timeout=5))
+        with self.assertNumQueries(0):
+            self.assertEquals(
+                self.handler.get_latest_message_id(self.chatview, room.id),
+                1000)
+
+
+class WriteBehindMessageHandlerTest(ChatViewTestCase):
+    def setUp(self):
+        super(WriteBehindMessageHandlerTest, self).setUp()
+        self.chatview = ChatView()
+        self.handler = WriteBehindMessageHandler(interval=3600)
+        self.default_handler = self.chatview.handler
+        self.chatview.handler = self.handler
+
+    def tearDown(self):
+        self.chatview.handler = self.default_handler
+        if self.handler.flusher is not None:
+            self.handler.flusher.kill()
+
+    def test_write_behind(self):
+        """Asserts messages are published before being saved,
+        and saved in bulk by flush
+
+        """
+        room = Room(name="Write behind room", slug="write-behind-room")
+        room.save()
+        self.chatview.allocate_room(room.id)
+        messages = [
+            self.handler.handle_received_message(
+                self.chatview, room.id, 'user', 'message %d' % i,
+                datetime.now())
+            for i in range(3)]
+        self.assertEquals(Message.objects.count(), 0)
+        self.assertEquals(self.handler.get_pending_count(), 3)
+        self.assertTrue(self.handler.get_write_lag() >= 0)
+        self.assertEquals(
+            [msg_id for msg_id, msg
+             in self.chatview.get_messages_queue(room.id)],
+            [msg.pk for msg in messages])
+
+        with self.assertNumQueries(1):
+            self.handler.flush_all()
+        self.assertEquals(self.handler.get_pending_count(), 0)
+        self.assertEquals(self.handler.get_write_lag(), 0)
+        self.assertEquals(
+            list(Message.objects.filter(room=room).order_by(
+                'pk').values_list('pk', 'content')),
+            [(msg.pk, msg.content) for msg in messages])
+        self.assertEquals(
+            type(Message.objects.get(pk=messages[0].pk)), Message)
+
+
+class WriteBehindFlushTest(ChatViewTestMixin, TransactionTestCase):
+    """Runs out of transactions, as failed inserts abort them """
+    def setUp(self):
+        super(WriteBehindFlushTest, self).setUp()
+        self.handler = WriteBehindMessageHandler(interval=3600)
+
+    def tearDown(self):
+        if self.handler.flusher is not None:
+            self.handler.flusher.kill()
+
+    def test_failed_flush(self):
+        """Asserts messages which can't be saved are dropped, and
+        don't keep the following ones from being saved
+
+        """
+        room = Room(name="Failed flush room", slug="failed-flush-room")
+        room.save()
+        chatview = ChatView()
+        chatview.allocate_room(room.id)
+        messages = [
+            self.handler.handle_received_message(
+                chatview, room.id, 'user', 'message %d' % i,
+                datetime.now())
+            for i in range(3)]
+        # another writer takes the id of the second message
+        Message.objects.create(pk=messages[1].pk, room=room,
+                               username='admin', date=datetime.now(),
+                               content='taken')
+
+        self.handler.flush_all()
+        self.assertEquals(self.handler.get_pending_count(), 0)
+        self.assertEquals(
+            list(Message.objects.filter(room=room).order_by(
+                'pk').values_list('content', flat=True)),
+            ['message 0', 'taken', 'message 2'])
+
+
+class RoomCacheTest(ChatViewTestCase):
+    def test_room_cache(self):
+        """Asserts rooms are read from db once, and read again when
+        they're saved or deleted
+
+        """
+        room = Room(name="Cached room", slug="cached-room",
+                    allow_anonymous_access=True)
+        room.save()
+        with self.assertNumQueries(1):
+            self.assertTrue(room_cache.get(pk=room.id).allow_anonymous_access)
+            self.assertEquals(room_cache.get(slug='cached-room').id, room.id)
+            self.assertEquals(room_cache.get(pk=str(room.id)).id, room.id)
+
+        room.slug = 'renamed-room'
+        room.allow_anonymous_access = False
+        room.save()
+        with self.assertNumQueries(2):
+            self.assertFalse(
+                room_cache.get(pk=room.id).allow_anonymous_access)
+            self.assertRaises(Room.DoesNotExist,
+                              room_cache.get, slug='cached-room')
+        self.assertEquals(room_cache.get(slug='renamed-room').id, room.id)
+
+        room_id = room.id
+        room.delete()
+        self.assertRaises(Room.DoesNotExist, room_cache.get, pk=room_id)
+
+    def test_room_cache_ttl(self):
+        room = Room(name="Expiring room", slug="expiring-room")
+        room.save()
+        cache = RoomCache(ttl=0.05)
+        with self.assertNumQueries(1):
+            cache.get(pk=room.id)
+            cache.get(pk=room.id)
+        time.sleep(0.1)
+        with self.assertNumQueries(1):
+            cache.get(pk=room.id)
+
+
+class AuthorizationCacheTest(ChatViewTestCase):
+    def test_decisions_cache(self):
+        """Asserts the test function runs once per user and room,
+        and again when the room subscribers change
+
+        """
+        user = User.objects.create_user('subscriber', 'sub@example.com',
+                                        'password')
+        room = Room(name="Subscribers room", slug="subscribers-room")
+        room.save()
+        request = RequestFactory().get('/', {'room_id': room.id})
+        check = authorization_cache.check
+        with self.assertNumQueries(1):
+            self.assertFalse(check(request, user, check_user_is_subscribed))
+            self.assertFalse(check(request, user, check_user_is_subscribed))
+
+        room.subscribers.add(user)
+        self.assertTrue(check(request, user, check_user_is_subscribed))
+        user.room_set.remove(room)
+        self.assertFalse(check(request, user, check_user_is_subscribed))
+        room.subscribers.add(user)
+        room.subscribers.clear()
+        with self.assertNumQueries(1):
+            self.assertFalse(check(request, user, check_user_is_subscribed))
+
+
+class ReadQuerysetTest(ChatViewTestCase):
+    def test_read_queryset(self):
+        """Asserts chat queries skip polymorphic resolution unless
+        a subclass of the queried model is registered
+
+        """
+        self.assertTrue(
+            read_queryset(Room.objects.all()).polymorphic_disabled)
+        polymorphic_registry.register(Room)
+        try:
+            self.assertFalse(
+                read_queryset(Room.objects.all()).polymorphic_disabled)
+            self.assertTrue(
+                read_queryset(Message.objects.all()).polymorphic_disabled)
+        finally:
+            polymorphic_registry.unregister(Room)
+
+
+class AdmissionTest(ChatViewTestCase):
+    def setUp(self):
+        super(AdmissionTest, self).setUp()
+        self.user = User.objects.create_user(
+            username='ringo', password='ringopasswd',
+            email='ringo@beatles.com')
+        self.user.is_staff = True
+        self.user.save()
+        self.client = Client()
+        self.client.login(username='ringo', password='ringopasswd')
+        self.max_room_waiters = admission.MAX_ROOM_WAITERS
+        admission.MAX_ROOM_WAITERS = 1
+
+    def tearDown(self):
+        admission.MAX_ROOM_WAITERS = self.max_room_waiters
+
+    def test_room_waiters_limit(self):
+        """Asserts requests exceeding the waiters of a room are
+        rejected by a 503 response, and waiters are reported
+
+        """
+        room = Room(name="Crowded room", slug="crowded-room")
+        room.save()
+        chatview = ChatView()
+        chatview.allocate_room(room.id)
+        waiter = gevent.spawn(chatview.wait_for_new_message, room.id, -1, 5)
+        gevent.sleep(0)
+
+        response = self.client.get(
+            '/chat/get_messages/',
+            {'room_id': room.id, 'latest_message_id': -1},
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEquals(response.status_code, 503)
+        self.assertEquals(response['Retry-After'],
+                          str(admission.RETRY_AFTER))
+
+        response = self.client.get('/chat/waiters/')
+        json_response = json.loads(response.content)
+        self.assertEquals(json_response['waiters'], 1)
+        self.assertEquals(json_response['rooms'], {str(room.id): 1})
+
+        chatview.signal_new_message_event(room.id)
+        self.assertTrue(waiter.get(timeout=1))
+        self.assertEquals(chatview.total_waiters, 0)
+
+
+class TimeoutTest(ChatViewTestCase):
+    def setUp(self):
+        super(TimeoutTest, self).setUp()
+        self.settings = (chat.ADAPTIVE_TIMEOUT, chat.TIMEOUT_JITTER,
+                         admission.MAX_WAITERS)
+
+    def tearDown(self):
+        (chat.ADAPTIVE_TIMEOUT, chat.TIMEOUT_JITTER,
+         admission.MAX_WAITERS) = self.settings
+
+    def test_jitter(self):
+        """Asserts timeouts are spread within the jitter bounds """
+        chat.ADAPTIVE_TIMEOUT = False
+        chat.TIMEOUT_JITTER = 0.2
+        chatview = ChatView()
+        timeouts = set(chatview.get_timeout([1], 10) for i in xrange(50))
+        self.assertTrue(len(timeouts) > 1)
+        self.assertTrue(all(8 <= timeout <= 12 for timeout in timeouts))
+
+    def test_adaptive_timeout(self):
+        """Asserts adaptive timeouts are stretched for quiet rooms and
+        shortened when there are many waiters
+
+        """
+        chat.ADAPTIVE_TIMEOUT = True
+        chat.TIMEOUT_JITTER = 0
+        admission.MAX_WAITERS = 100
+        room = Room(name="Quiet room", slug="quiet-room")
+        room.save()
+        chatview = ChatView()
+        chatview.allocate_room(room.id)
+        self.assertEquals(chatview.get_timeout([room.id], 10), 10)
+
+        chatview.last_message_time[room.id] = time.time() - 60
+        self.assertEquals(chatview.get_timeout([room.id], 10), 20)
+
+        chatview.signal_new_message_event(room.id)
+        self.assertEquals(chatview.get_timeout([room.id], 10), 10)
+
+        chatview.total_waiters = 50
+        try:
+            self.assertEquals(chatview.get_timeout([room.id], 10), 6.25)
+            chatview.total_waiters = 200
+            self.assertEquals(chatview.get_timeout([room.id], 10), 2.5)
+        finally:
+            chatview.total_waiters = 0
+
+
+class PresenceTest(ChatViewTestCase):
+    def test_presence(self):
+        """Asserts users are ordered by the time they were last seen,
+        and joins and leaves bump the version
+
+        """
+        presence = Presence(granularity=60)
+        self.assertTrue(presence.touch('john', now=10))
+        self.assertTrue(presence.touch('paul', now=20))
+        self.assertFalse(presence.touch('john', now=30))
+        self.assertEquals(list(presence), ['paul', 'john'])
+        self.assertEquals(presence.version, 2)
+        encoded = presence.encode()
+        self.assertIs(presence.encode(), encoded)
+
+        self.assertEquals(presence.expire(15, now=40), ['paul'])
+        self.assertEquals(presence.expire(15, now=40), [])
+        self.assertEquals(list(presence), ['john'])
+        self.assertEquals(presence.version, 3)
+        self.assertEquals(
+            [user['username'] for user in json.loads(presence.encode())],
+            ['john'])
+
+        self.assertTrue(presence.remove('john'))
+        self.assertFalse(presence.remove('john'))
+        self.assertEquals(presence.version, 4)
+
+    def test_presence_changes(self):
+        """Asserts clients get the latest change of each user following
+        their version, with refreshes coalesced by granularity, unless
+        the changes aren't all logged anymore
+
+        """
+        presence = Presence(log_size=4, granularity=10)
+        presence.touch('john', now=0)
+        presence.touch('paul', now=0)
+        self.assertEquals(presence.version, 2)
+        presence.touch('john', now=5)
+        self.assertEquals(presence.version, 2)
+        presence.touch('john', now=10)
+        self.assertEquals(presence.version, 3)
+        self.assertEquals(presence.members_version, 2)
+        presence.remove('paul')
+
+        changes = json.loads(presence.encode_changes(1))
+        self.assertEquals(
+            [user['username'] for user in changes['changed']], ['john'])
+        self.assertEquals(changes['left'], ['paul'])
+        self.assertIs(presence.encode_changes(1), presence.encode_changes(1))
+        self.assertEquals(json.loads(presence.encode_changes(4)),
+                          {'changed': [], 'left': []})
+        self.assertEquals(presence.encode_changes(5), None)
+
+        presence.touch('ringo', now=20)
+        self.assertEquals(presence.encode_changes(0), None)
+        self.assertEquals(
+            sorted(user['username'] for user
+                   in json.loads(presence.encode_changes(1))['changed']),
+            ['john', 'ringo'])
+
+    def test_sweep_presence(self):
+        """Asserts the sweep drops users not seen for a while and
+        wakes up the users list waiters
+
+        """
+        room = Room(name="Sweep room", slug="sweep-room")
+        room.save()
+        chatview = ChatView()
+        chatview.get_connected_users(room.id).touch(
+                        'paul', now=time.time() - 120)
+        chatview.update_connected_user(room.id, 'john')
+        event = chatview.new_connected_user_event[room.id]
+        chatview.sweep_presence(max_age=60)
+        self.assertTrue(event.is_set())
+        self.assertEquals(list(chatview.get_connected_users(room.id)),
+                          ['john'])
+
+    def test_streamed_presence(self):
+        """Asserts the user of an events stream is kept among connected
+        users while messages are streamed, and gets the users changes
+        following them
+
+        """
+        room = Room(name="Stream room", slug="stream-room")
+        room.save()
+        chatview = ChatView()
+        events = chatview.generate_events(room.id, -1, 'john', max_time=5)
+        self.assertTrue(next(events).startswith('retry: '))
+        self.assertTrue(next(events).startswith('event: users\n'))
+
+        chatview.get_connected_users(room.id).touch(
+                        'john', now=time.time() - 120)
+        chatview.update_connected_user(room.id, 'paul')
+        chatview.handler.handle_received_message(
+                        chatview, room.id, 'paul', 'Hi', datetime.now())
+        self.assertTrue(next(events).startswith('id: '))
+        chatview.sweep_presence(max_age=60)
+        self.assertIn('john', chatview.get_connected_users(room.id))
+        users = next(events)
+        self.assertTrue(users.startswith('event: users\n'))
+        self.assertIn('paul', users)
+
+
+class BrokerMessageHandlerTest(ChatViewTestCase):
+    """Runs a broker process, relaying the events of the ChatView
+    handler to a socket standing for another worker process, and back
+
+    """
+    def setUp(self):
+        super(BrokerMessageHandlerTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'broker.sock')
+        self.broker = subprocess.Popen(
+            [sys.executable, '-c',
+             'from chatrooms.utils.broker_handlers import Broker; '
+             'Broker(%r).serve_forever()' % self.path],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        self.worker = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        for attempt in xrange(50):
+            try:
+                self.worker.connect(self.path)
+                break
+            except socket.error:
+                gevent.sleep(0.1)
+        self.worker.settimeout(5)
+        self.worker_events = self.worker.makefile('rb')
+
+        self.chatview = ChatView()
+        self.handler = BrokerMessageHandler(self.path)
+        self.default_handler = self.chatview.handler
+        self.chatview.handler = self.handler
+        self.handler.start_receiver(self.chatview)
+        # lets the broker register both connections
+        gevent.sleep(0.5)
+
+    def tearDown(self):
+        self.chatview.handler = self.default_handler
+        self.handler.receiver.kill()
+        self.worker.close()
+        self.broker.terminate()
+        self.broker.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def send_worker_event(self, **event):
+        self.worker.sendall(json.dumps(event) + '\n')
+
+    def read_worker_event(self):
+        return json.loads(self.worker_events.readline())
+
+    def test_relayed_messages(self):
+        """Asserts messages are relayed between workers, waking up
+        the requests waiting on their room
+
+        """
+        room = Room(name="Broker room", slug="broker-room")
+        room.save()
+        self.chatview.allocate_room(room.id)
+
+        message = self.handler.handle_received_message(
+            self.chatview, room.id, 'john', 'Hi', datetime.now())
+        event = self.read_worker_event()
+        self.assertEquals(event['type'], 'message')
+        self.assertEquals(event['room_id'], room.id)
+        self.assertEquals(event['message_id'], message.pk)
+        self.assertEquals(event['content'], 'Hi')
+
+        waiter = gevent.spawn(self.chatview.wait_for_new_message,
+                              room.id, message.pk, 5)
+        gevent.sleep(0)
+        self.send_worker_event(
+            type='message', room_id=room.id, message_id=message.pk + 1,
+            username='paul', date=datetime.now().strftime(TIME_FORMAT),
+            content='Hello')
+        self.assertTrue(waiter.get(timeout=2))
+        messages = self.handler.retrieve_messages(
+                        self.chatview, room.id, message.pk)
+        self.assertEquals([(msg_id, msg.content) for msg_id, msg in messages],
+                          [(message.pk + 1, 'Hello')])
+
+    def test_room_lock(self):
+        """Asserts messages of a room are saved one at a time, so that
+        they're relayed in the order of their ids
+
+        """
+        room = Room(name="Broker lock", slug="broker-lock")
+        room.save()
+        self.chatview.allocate_room(room.id)
+        self.send_worker_event(type='lock', room_id=room.id)
+        self.assertEquals(self.read_worker_event(),
+                          {'type': 'locked', 'room_id': room.id})
+        # the other worker saves its message holding the lock
+        other = Message.objects.create(room=room, username='paul',
+                                       date=datetime.now(), content='Hi')
+        gevent.spawn_later(
+            0.2, self.send_worker_event, type='message', locked=True,
+            room_id=room.id, message_id=other.pk, username='paul',
+            date=other.date.strftime(TIME_FORMAT), content='Hi')
+
+        message = self.handler.handle_received_message(
+            self.chatview, room.id, 'john', 'Hello', datetime.now())
+        self.assertTrue(message.pk > other.pk)
+        self.assertEquals([self.read_worker_event()['message_id'],
+                           self.read_worker_event()['message_id']],
+                          [other.pk, message.pk])
+        self.assertEquals(
+            [msg_id for msg_id, msg
+             in self.chatview.get_messages_queue(room.id)],
+            [other.pk, message.pk])
+
+    def test_relayed_presence(self):
+        """Asserts users joining a room are relayed between workers """
+        room = Room(name="Broker presence", slug="broker-presence")
+        room.save()
+        self.chatview.update_connected_user(room.id, 'john')
+        self.assertEquals(
+            self.read_worker_event(),
+            {'type': 'presence', 'room_id': room.id, 'username': 'john'})
+
+        event = self.chatview.new_connected_user_event[room.id]
+        self.send_worker_event(
+            type='presence', room_id=room.id, username='paul')
+        self.assertTrue(event.wait(timeout=2))
+        self.assertEquals(list(self.chatview.get_connected_users(room.id)),
+                          ['john', 'paul'])
+
+    def test_resync(self):
+        """Asserts workers whose connection failed make the other
+        workers read their rooms messages from db again
+
+        """
+        self.handler.send({'type': 'presence', 'room_id': 0,
+                           'username': 'john'})
+        self.assertEquals(self.read_worker_event()['username'], 'john')
+        self.handler.disconnect(self.handler.connection)
+        self.handler.send({'type': 'presence', 'room_id': 0,
+                           'username': 'paul'})
+        self.assertEquals(self.read_worker_event(), {'type': 'resync'})
+        self.assertEquals(self.read_worker_event()['username'], 'paul')
+
+        room = Room(name="Broker resync", slug="broker-resync")
+        room.save()
+        self.chatview.allocate_room(room.id)
+        event = self.chatview.new_message_events[room.id]
+        # a message whose event has been lost
+        message = Message.objects.create(room=room, username='paul',
+                                         date=datetime.now(), content='Hi')
+        self.handler.on_broker_event(self.chatview, {'type': 'resync'})
+        self.assertTrue(event.is_set())
+        self.assertEquals(
+            [msg_id for msg_id, msg
+             in self.chatview.get_messages_queue(room.id)], [message.pk])
+
+
+class CacheMessageHandlerTest(ChatViewTestCase):
+    """Uses two handlers sharing a locmem cache, the one of the ChatView
+    and the one of another worker process
+
+    """
+    def setUp(self):
+        super(CacheMessageHandlerTest, self).setUp()
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                          LOCATION='chatrooms-tests')
+        cache.clear()
+        self.chatview = ChatView()
+        self.handler = CacheMessageHandler(cache)
+        self.other_handler = CacheMessageHandler(cache)
+        self.default_handler = self.chatview.handler
+        self.chatview.handler = self.handler
+        self.handler.start_poller(self.chatview)
+
+    def tearDown(self):
+        self.chatview.handler = self.default_handler
+        self.handler.poller.kill()
+
+    def test_shared_messages(self):
+        """Asserts messages stored by another process wake up the
+        requests waiting on their room, and are read from cache
+
+        """
+        room = Room(name="Cache room", slug="cache-room")
+        room.save()
+        first = Message(room=room, username='john', content='Hi',
+                        date=datetime.now())
+        first.save()
+        self.assertEquals(
+            self.handler.get_latest_message_id(self.chatview, room.id),
+            first.pk)
+        waiter = gevent.spawn(self.chatview.wait_for_new_message,
+                              room.id, first.pk, 5)
+        gevent.sleep(0)
+
+        message = Message(room=room, username='paul', content='Hello',
+                          date=datetime.now())
+        message.save()
+        self.other_handler.store_message(room.id, message)
+        self.assertTrue(waiter.get(timeout=2))
+        with self.assertNumQueries(0):
+            self.assertEquals(
+                self.handler.get_latest_message_id(self.chatview, room.id),
+                message.pk)
+            messages = self.handler.retrieve_messages(
+                            self.chatview, room.id, -1)
+            self.assertEquals([msg.content for msg_id, msg in messages],
+                              ['Hi', 'Hello'])
+
+        # messages missing from the cache are read from db, as well as
+        # the latest message id, once the memoized messages are dropped
+        self.handler.cache.delete(self.handler.get_message_key(room.id, 1))
+        self.handler.windows.clear()
+        with self.assertNumQueries(2):
+            messages = self.handler.retrieve_messages(
+                            self.chatview, room.id, -1)
+        self.assertEquals([msg_id for msg_id, msg in messages],
+                          [first.pk, message.pk])
+
+    def test_room_lock(self):
+        """Asserts messages of a room are stored one at a time, in the
+        order of their ids
+
+        """
+        room = Room(name="Cache lock", slug="cache-lock")
+        room.save()
+        self.handler.get_latest_message_id(self.chatview, room.id)
+        # another process saves a message holding the lock
+        token = self.other_handler.lock_room(room.id)
+        other = Message.objects.create(room=room, username='paul',
+                                       date=datetime.now(), content='Hi')
+
+        def store():
+            self.other_handler.store_message(room.id, other)
+            self.other_handler.unlock_room(room.id, token)
+        gevent.spawn_later(0.2, store)
+
+        message = self.handler.handle_received_message(
+                    self.chatview, room.id, 'john', 'Hello', datetime.now())
+        self.assertEquals(
+            [self.handler.cache.get(
+                self.handler.get_message_key(room.id, seq))[0]
+             for seq in (1, 2)],
+            [other.pk, message.pk])
+
+    def test_shared_presence(self):
+        """Asserts users stored by another process join the room """
+        room = Room(name="Cache presence", slug="cache-presence")
+        room.save()
+        self.chatview.allocate_room(room.id)
+        event = self.chatview.new_connected_user_event[room.id]
+        waiter = gevent.spawn(self.chatview.wait_for_room_event,
+                              room.id, event, 5)
+        gevent.sleep(0)
+
+        self.other_handler.handle_presence(self.chatview, room.id, 'paul')
+        self.assertTrue(waiter.get(timeout=2))
+        self.assertIn('paul', self.chatview.get_connected_users(room.id))
+
+    def test_first_message(self):
+        """Asserts the first message of a room not in cache is stored
+        once, as well as the first message after its eviction
+
+        """
+        room = Room(name="Cache first", slug="cache-first")
+        room.save()
+        first = self.handler.handle_received_message(
+                    self.chatview, room.id, 'john', 'Hi', datetime.now())
+        messages = self.handler.retrieve_messages(self.chatview, room.id, -1)
+        self.assertEquals([(msg_id, msg.content) for msg_id, msg in messages],
+                          [(first.pk, 'Hi')])
+
+        self.handler.cache.delete(self.handler.get_sequence_key(room.id))
+        second = self.handler.handle_received_message(
+                    self.chatview, room.id, 'paul', 'Hello', datetime.now())
+        messages = self.handler.retrieve_messages(self.chatview, room.id, -1)
+        self.assertEquals([msg_id for msg_id, msg in messages],
+                          [first.pk, second.pk])
+
+    def test_read_before_poll(self):
+        """Asserts messages stored by another process wake up the
+        waiting requests, even if a request reads the room before the
+        poller finds them
+
+        """
+        room = Room(name="Cache read", slug="cache-read")
+        room.save()
+        latest_msg_id = self.handler.get_latest_message_id(
+                            self.chatview, room.id)
+        # the poller finds the sequence number of the room
+        gevent.spawn(self.chatview.wait_for_new_message,
+                     room.id, latest_msg_id, 5)
+        gevent.sleep(CACHE_POLL_INTERVAL * 2.5)
+        waiter = gevent.spawn(self.chatview.wait_for_new_message,
+                              room.id, latest_msg_id, 5)
+        gevent.sleep(0)
+
+        message = Message(room=room, username='paul', content='Hello',
+                          date=datetime.now())
+        message.save()
+        self.other_handler.store_message(room.id, message)
+        self.assertEquals(
+            self.handler.get_latest_message_id(self.chatview, room.id),
+            message.pk)
+        self.assertTrue(waiter.get(timeout=2))
@@ -25,8 +25,13 @@ urlpatterns = patterns('chatrooms',
 
     # ajax requests
     url(r'^get_messages/', chat.ChatView().get_messages),
+    url(r'^get_rooms_messages/', chat.ChatView().get_rooms_messages),
+    url(r'^get_history/', chat.ChatView().get_history),
+    url(r'^stream_events/', chat.ChatView().stream_events),
     url(r'^send_message/', chat.ChatView().send_message),
     url(r'^get_latest_msg_id/', chat.ChatView().get_latest_message_id),
     url(r'^get_users_list/$', chat.ChatView().get_users_list),
     url(r'^notify_users_list/$', chat.ChatView().notify_users_list),
+    url(r'^sync/$', chat.ChatView().sync),
+    url(r'^waiters/$', chat.ChatView().get_waiters),
 )
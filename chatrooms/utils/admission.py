@@ -0,0 +1,60 @@
+#encoding=utf8
+
+from django.conf import settings
+from django.utils.decorators import available_attrs
+from django.utils.functional import wraps
+
+from .compat import HttpResponse
+
+
+# None means no limit
+MAX_WAITERS = getattr(settings, 'CHATROOMS_MAX_WAITERS', None)
+
+MAX_ROOM_WAITERS = getattr(settings, 'CHATROOMS_MAX_ROOM_WAITERS', None)
+
+RETRY_AFTER = getattr(settings, 'CHATROOMS_RETRY_AFTER', 5)
+
+
+class TooManyWaiters(Exception):
+    """Raised when a request would exceed the limits of requests
+    waiting for room events
+
+    """
+    pass
+
+
+def check_waiters_limits(total_waiters, room_waiters):
+    """
+    Raises TooManyWaiters if one more waiter would exceed
+    settings.CHATROOMS_MAX_WAITERS, given the number of requests
+    waiting in the process, or settings.CHATROOMS_MAX_ROOM_WAITERS,
+    given a dictionary of the number of requests waiting by room id
+
+    """
+    if MAX_WAITERS is not None and total_waiters >= MAX_WAITERS:
+        raise TooManyWaiters(
+            "Too many waiting requests (%d)" % total_waiters)
+    if MAX_ROOM_WAITERS is not None:
+        for room_id, waiters in room_waiters.iteritems():
+            if waiters >= MAX_ROOM_WAITERS:
+                raise TooManyWaiters(
+                    "Too many waiting requests in room %s (%d)" % (
+                        room_id, waiters))
+
+
+def service_unavailable_if_busy(view_func):
+    """Decorator for views that wait for room events
+    Returns a 503 response with a Retry-After header
+    (settings.CHATROOMS_RETRY_AFTER seconds) if the view
+    raises TooManyWaiters
+
+    """
+    @wraps(view_func, assigned=available_attrs(view_func))
+    def _wrapped_view(request, *args, **kwargs):
+        try:
+            return view_func(request, *args, **kwargs)
+        except TooManyWaiters as exc:
+            response = HttpResponse(str(exc), status=503)
+            response['Retry-After'] = str(RETRY_AFTER)
+            return response
+    return _wrapped_view
@@ -1,13 +1,23 @@
 #encoding=utf8
+import copy
+import time
 import urlparse
 
 from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import m2m_changed
+from django.dispatch import receiver
 from django.http import QueryDict
 
 from django_load.core import load_object
 
+from .rooms import room_cache
+from ..models import Room
+
+
+AUTH_CACHE_TTL = getattr(settings, 'CHATROOMS_AUTH_CACHE_TTL', 30)
+
 
 def get_login_url(next, login_url=None,
                       redirect_field_name=REDIRECT_FIELD_NAME):
@@ -43,12 +53,149 @@ def get_test_user_function():
 test_user_function = get_test_user_function()
 
 
+class AuthorizationCache(object):
+    """
+    Caches the results of test_user_function by room and by user,
+    or by session for anonymous users, for ttl seconds
+    (settings.CHATROOMS_AUTH_CACHE_TTL, 30 by default; 0 disables
+    the cache), so that polling requests don't run the test each time.
+
+    Decisions are dropped when the subscribers of their room change.
+    Expired decisions are dropped at most once every ttl seconds.
+
+    """
+    def __init__(self, ttl=AUTH_CACHE_TTL):
+        self.ttl = ttl
+        # {room_id: {user_key: (decision, expiry time)}}
+        self.decisions = {}
+        self.last_purge = time.time()
+
+    def get_user_key(self, request, user):
+        """Returns the key of the user, or of the session of anonymous
+        users, None if the request has no session
+
+        """
+        if user.is_authenticated():
+            return ('user', user.pk)
+        session = getattr(request, 'session', None)
+        if session is not None and session.session_key:
+            return ('session', session.session_key)
+        return None
+
+    def check(self, request, user, test_func):
+        """Returns the cached decision of test_func for the request
+        user and room, running test_func if it isn't cached or expired
+
+        """
+        try:
+            room_id = int(request.REQUEST['room_id'])
+        except (KeyError, ValueError, TypeError):
+            room_id = None
+        user_key = self.get_user_key(request, user)
+        if not self.ttl or room_id is None or user_key is None:
+            return test_func(request, user)
+        now = time.time()
+        entry = self.decisions.get(room_id, {}).get(user_key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        decision = test_func(request, user)
+        self.purge_expired(now)
+        self.decisions.setdefault(room_id, {})[user_key] = (
+                            decision, now + self.ttl)
+        return decision
+
+    def purge_expired(self, now):
+        """Drops the expired decisions, once every self.ttl seconds """
+        if now - self.last_purge < self.ttl:
+            return
+        self.last_purge = now
+        for room_id, decisions in self.decisions.items():
+            for user_key, (decision, expires) in decisions.items():
+                if expires <= now:
+                    del decisions[user_key]
+            if not decisions:
+                del self.decisions[room_id]
+
+    def invalidate(self, room_ids=None, user_ids=None):
+        """Drops the decisions of the given rooms and users, of any room
+        if room_ids is None, of any user if user_ids is None
+
+        """
+        if room_ids is None:
+            room_ids = self.decisions.keys()
+        for room_id in room_ids:
+            if user_ids is None:
+                self.decisions.pop(room_id, None)
+                continue
+            decisions = self.decisions.get(room_id, {})
+            for user_id in user_ids:
+                decisions.pop(('user', user_id), None)
+
+    def clear(self):
+        """Drops all the decisions """
+        self.decisions.clear()
+
+
+authorization_cache = AuthorizationCache()
+
+
 def check_user_passes_test(request, user):
     """
-    Returns the test_user_function if any,
+    Returns the (cached) result of test_user_function if any,
     else returns True
 
     """
     if test_user_function:
-        return test_user_function(request, user)
+        return authorization_cache.check(request, user, test_user_function)
     return True
+
+
+def get_room_request(request, room_id):
+    """Returns a copy of request whose room_id GET parameter is set
+    to room_id, for testing the access to each room of requests
+    for several rooms
+
+    """
+    room_request = copy.copy(request)
+    room_request.GET = request.GET.copy()
+    room_request.GET['room_id'] = str(room_id)
+    # drops the cached merge of GET and POST parameters
+    room_request.__dict__.pop('_request', None)
+    return room_request
+
+
+def check_user_can_access_room(request, user, room_id):
+    """
+    Returns True if the room exists, it allows anonymous access or
+    the user is authenticated, and the user passes the test_user_function
+    for the room, else returns False
+
+    """
+    try:
+        room = room_cache.get(pk=room_id)
+    except (Room.DoesNotExist, ValueError):
+        return False
+    if not (room.allow_anonymous_access or user.is_authenticated()):
+        return False
+    return check_user_passes_test(get_room_request(request, room_id), user)
+
+
+@receiver(m2m_changed, sender=Room.subscribers.through)
+def invalidate_subscribers_decisions(sender, **kwargs):
+    """Drops the cached decisions of the users whose subscriptions
+    have changed
+
+    """
+    action = kwargs.get('action')
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    instance = kwargs.get('instance')
+    pk_set = kwargs.get('pk_set')
+    if kwargs.get('reverse'):
+        # user.room_set changed
+        authorization_cache.invalidate(room_ids=pk_set,
+                                       user_ids=[instance.pk])
+    else:
+        # room.subscribers changed
+        authorization_cache.invalidate(room_ids=[instance.pk],
+                                       user_ids=pk_set)
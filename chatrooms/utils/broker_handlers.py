@@ -0,0 +1,443 @@
+#encoding=utf8
+import json
+import logging
+import os
+from collections import deque
+from datetime import datetime
+
+import gevent
+from gevent import socket
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
+from gevent.queue import Full, Queue
+from gevent.server import StreamServer
+
+from django.conf import settings
+
+from .handlers import MessageHandler
+from .messagelog import MessageRecord
+from .serializers import TIME_FORMAT, serialize_message
+
+
+BROKER_SOCKET = getattr(settings, 'CHATROOMS_BROKER_SOCKET',
+                        '/tmp/chatrooms-broker.sock')
+
+# events queued for a worker before the broker drops its connection
+BROKER_QUEUE_SIZE = getattr(settings, 'CHATROOMS_BROKER_QUEUE_SIZE', 10000)
+
+# seconds workers wait for the broker to grant a room lock or to relay
+# a message back, before connecting again
+BROKER_TIMEOUT = getattr(settings, 'CHATROOMS_BROKER_TIMEOUT', 5)
+
+logger = logging.getLogger(__name__)
+
+
+class Broker(object):
+    """
+    Relays the events sent by each worker process of a host to the
+    other workers, over a UNIX domain socket.
+
+    Events are lines of JSON, which are relayed as they are, in the
+    order the broker receives them. Each worker has a queue of at most
+    queue_size events (settings.CHATROOMS_BROKER_QUEUE_SIZE): workers
+    not reading their events are disconnected, and get the messages
+    they missed from db when they connect again, while the other
+    workers get the messages they failed to send from db on their
+    "resync" event.
+
+    Messages of a room are saved one at a time: workers request the
+    lock of the room by a "lock" event, and save the message once the
+    broker answers with a "locked" event. The lock is released by the
+    message event, which is relayed to the sender too, by an "unlock"
+    event, or when the worker disconnects. Message ids, the db primary
+    keys, are then relayed in increasing order within each room.
+
+    """
+    def __init__(self, path=BROKER_SOCKET, queue_size=BROKER_QUEUE_SIZE):
+        self.path = path
+        self.queue_size = queue_size
+        # queue of the events to send by worker connection
+        self.queues = {}
+        # worker connections requesting the lock of a room by room id,
+        # the first one holding it
+        self.room_locks = {}
+
+    def serve_forever(self):
+        """Listens to the socket and relays the workers events """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(128)
+        StreamServer(listener, self.handle).serve_forever()
+
+    def handle(self, connection, address):
+        """Relays the events sent by a worker to the other workers,
+        and its messages back to it, handling its room locks
+
+        """
+        queue = Queue(self.queue_size)
+        self.queues[connection] = queue
+        writer = gevent.spawn(self.write, connection, queue)
+        try:
+            for line in connection.makefile('rb'):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if event['type'] == 'lock':
+                    self.lock_room(connection, event['room_id'])
+                elif event['type'] == 'unlock':
+                    self.unlock_room(connection, event['room_id'])
+                elif event['type'] == 'message':
+                    self.relay(connection, line, to_sender=True)
+                    if event.get('locked'):
+                        self.unlock_room(connection, event['room_id'])
+                else:
+                    self.relay(connection, line)
+        except socket.error:
+            pass
+        finally:
+            self.queues.pop(connection, None)
+            self.release_locks(connection)
+            writer.kill()
+            connection.close()
+
+    def put(self, connection, line):
+        """Queues an event for a worker, dropping the worker if its
+        queue is full
+
+        """
+        queue = self.queues.get(connection)
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(line)
+        except Full:
+            logger.warning("Dropping a slow chatrooms worker")
+            self.queues.pop(connection, None)
+            connection.close()
+
+    def relay(self, connection, line, to_sender=False):
+        """Queues an event of a worker for the other workers """
+        for other in self.queues.keys():
+            if other is not connection or to_sender:
+                self.put(other, line)
+
+    def lock_room(self, connection, room_id):
+        """Queues a worker among the ones requesting a room lock,
+        granting it if the room isn't locked
+
+        """
+        waiting = self.room_locks.setdefault(room_id, deque())
+        waiting.append(connection)
+        if len(waiting) == 1:
+            self.grant(room_id)
+
+    def grant(self, room_id):
+        """Sends a "locked" event to the first worker requesting the
+        lock of a room, if any
+
+        """
+        waiting = self.room_locks.get(room_id)
+        if not waiting:
+            self.room_locks.pop(room_id, None)
+            return
+        self.put(waiting[0],
+                 json.dumps({'type': 'locked', 'room_id': room_id}) + '\n')
+
+    def unlock_room(self, connection, room_id):
+        """Releases a room lock held by a worker """
+        waiting = self.room_locks.get(room_id)
+        if waiting and waiting[0] is connection:
+            waiting.popleft()
+            self.grant(room_id)
+
+    def release_locks(self, connection):
+        """Drops the lock requests of a disconnected worker, releasing
+        the locks it held
+
+        """
+        for room_id, waiting in self.room_locks.items():
+            if connection not in waiting:
+                continue
+            held = waiting[0] is connection
+            self.room_locks[room_id] = deque(
+                other for other in waiting if other is not connection)
+            if held:
+                self.grant(room_id)
+
+    def write(self, connection, queue):
+        """Sends the queued events to a worker """
+        try:
+            for line in queue:
+                connection.sendall(line)
+        except socket.error:
+            self.queues.pop(connection, None)
+            connection.close()
+
+
+class BrokerMessageHandler(MessageHandler):
+    """Custom MessageHandler class using a local broker process
+    (see Broker) for synchronization of the worker processes of a host
+
+    Messages are saved holding the lock of their room granted by the
+    broker, then sent to the broker along with their room id, as well
+    as the users joining rooms or seen again.
+    A single receiver greenlet per process gets the events from the
+    broker: it appends the messages of all the workers, its own
+    included, to the rooms messages queues in the order the broker
+    relays them, keeps the users of the other workers among the
+    connected users and wakes up the waiting requests.
+    Message ids are the db primary keys, shared by all the workers:
+    as messages of a room are saved one at a time, they're relayed in
+    the order of their ids, and clients which got a message don't miss
+    the ones preceding it.
+
+    Events may be lost when the connection to the broker fails, and
+    messages are then saved and queued without the room lock: the
+    first event sent on a new connection following a failed one is a
+    "resync" event, making the other workers read their rooms messages
+    from db again.
+
+    """
+    def __init__(self, path=BROKER_SOCKET):
+        self.path = path
+        self.connection = None
+        self.lock = Semaphore()
+        self.receiver = None
+        # whether events might have been lost since the latest connection
+        self.resync = False
+        # AsyncResult objects of the room lock requests, by room id
+        self.lock_waiters = {}
+        # AsyncResult objects of the messages sent, by message id
+        self.echo_waiters = {}
+
+    def start_receiver(self, chatobj):
+        """Spawns the receiver greenlet, unless it's running """
+        if self.receiver is None or self.receiver.dead:
+            self.receiver = gevent.spawn(self.listen, chatobj)
+
+    def connect(self):
+        """Returns the connection to the broker, connecting if needed,
+        and sending a "resync" event first if events might have been lost
+        Raises socket.error if the broker can't be reached
+
+        """
+        with self.lock:
+            if self.connection is None:
+                connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    connection.connect(self.path)
+                    if self.resync:
+                        connection.sendall(
+                            json.dumps({'type': 'resync'}) + '\n')
+                except socket.error:
+                    connection.close()
+                    raise
+                self.connection = connection
+                self.resync = False
+            return self.connection
+
+    def disconnect(self, connection):
+        """Closes the connection to the broker, unless it's been
+        replaced already: events sent on it might have been lost, and
+        the requests waiting for the broker answers give up
+
+        """
+        with self.lock:
+            if self.connection is not connection:
+                connection.close()
+                return
+            self.connection = None
+            self.resync = True
+        connection.close()
+        waiters = self.echo_waiters.values()
+        for room_waiters in self.lock_waiters.values():
+            waiters.extend(room_waiters)
+        self.lock_waiters.clear()
+        self.echo_waiters.clear()
+        for waiter in waiters:
+            waiter.set(False)
+
+    def send(self, event):
+        """Sends an event to the broker; events are lost while the
+        broker can't be reached, and the other workers are resynced
+        on the next connection
+        Returns True if the event has been sent
+
+        """
+        try:
+            connection = self.connect()
+        except socket.error:
+            logger.warning("The chatrooms broker can't be reached")
+            self.resync = True
+            return False
+        try:
+            with self.lock:
+                connection.sendall(json.dumps(event) + '\n')
+        except socket.error:
+            self.disconnect(connection)
+            return False
+        return True
+
+    def wait_for_broker(self, waiter):
+        """Waits for the broker answer set on waiter, disconnecting
+        if it doesn't come in settings.CHATROOMS_BROKER_TIMEOUT seconds
+        Returns True if the broker answered
+
+        """
+        try:
+            return waiter.get(timeout=BROKER_TIMEOUT)
+        except gevent.Timeout:
+            logger.warning("The chatrooms broker doesn't answer")
+            connection = self.connection
+            if connection is not None:
+                self.disconnect(connection)
+            return False
+
+    def lock_room(self, room_id):
+        """Waits for the broker to grant the lock of a room
+        Returns False if the broker can't be reached
+
+        """
+        waiter = AsyncResult()
+        self.lock_waiters.setdefault(room_id, deque()).append(waiter)
+        if not self.send({'type': 'lock', 'room_id': room_id}):
+            room_waiters = self.lock_waiters.get(room_id)
+            if room_waiters and waiter in room_waiters:
+                room_waiters.remove(waiter)
+            return False
+        return self.wait_for_broker(waiter)
+
+    def listen(self, chatobj):
+        """
+        Reads the events of the other workers from the broker and calls
+        self.on_broker_event for each of them.
+        On connection errors, connects again, then reloads the messages
+        queues from db and wakes up all the waiting requests, as
+        messages might have been missed.
+
+        """
+        missed = False
+        while True:
+            try:
+                connection = self.connect()
+            except socket.error:
+                missed = True
+                gevent.sleep(1)
+                continue
+            if missed:
+                self.reload_rooms(chatobj)
+            try:
+                for line in connection.makefile('rb'):
+                    self.on_broker_event(chatobj, json.loads(line))
+            except socket.error:
+                pass
+            self.disconnect(connection)
+            missed = True
+
+    def reload_rooms(self, chatobj):
+        """Reloads the messages queues of the rooms allocated by chatobj
+        from db and wakes up all the waiting requests
+
+        """
+        self.load_latest_messages(chatobj, chatobj.messages.keys())
+        for room_id in chatobj.new_message_events.keys():
+            chatobj.signal_new_message_event(room_id)
+
+    def on_broker_event(self, chatobj, event):
+        """
+        Handles an event relayed by the broker, for the rooms allocated
+        by chatobj: the other rooms get the messages from db when
+        they're allocated
+        - "message" events, of any worker, are appended to the room
+          messages queue, signaling new_message_event
+        - "presence" events keep the user among the connected users,
+          signaling new_connected_user_event if the user joined
+        - "resync" events reload the rooms (see self.reload_rooms),
+          as the worker might have failed to send some messages
+        - "locked" events grant a room lock to the first request
+          waiting for it, or are given back if it gave up
+
+        """
+        if event['type'] == 'resync':
+            self.reload_rooms(chatobj)
+            return
+        room_id = event['room_id']
+        if event['type'] == 'locked':
+            room_waiters = self.lock_waiters.get(room_id)
+            if room_waiters:
+                room_waiters.popleft().set(True)
+            else:
+                self.send({'type': 'unlock', 'room_id': room_id})
+            return
+        echo_waiter = None
+        if event['type'] == 'message':
+            echo_waiter = self.echo_waiters.pop(event['message_id'], None)
+        if room_id in chatobj.last_activity:
+            if event['type'] == 'message':
+                record = MessageRecord(
+                    event['message_id'], event['username'],
+                    datetime.strptime(event['date'], TIME_FORMAT),
+                    event['content'])
+                chatobj.messages[room_id].append((record.id, record))
+                chatobj.signal_new_message_event(room_id)
+            elif event['type'] == 'presence':
+                if chatobj.connected_users[room_id].touch(event['username']):
+                    chatobj.signal_new_connected_user_event(room_id)
+        if echo_waiter is not None:
+            echo_waiter.set(True)
+
+    def handle_received_message(self,
+        sender, room_id, username, message, date, **kwargs):
+        """
+        1. waits for the broker to grant the room lock
+        2. saves the message, giving the lock back if it fails
+        3. sends the message to the broker, which relays it to all the
+        workers and releases the lock
+        4. waits for the message to be relayed back and appended to the
+        room messages queue by the receiver, or appends it if the broker
+        can't be reached, signaling new_message_event
+        5. returns the created message
+
+        """
+        self.start_receiver(sender)
+        # 1
+        locked = self.lock_room(room_id)
+        # 2
+        try:
+            new_message = self.create_message(
+                        room_id, username, message, date, **kwargs)
+        except Exception:
+            if locked:
+                self.send({'type': 'unlock', 'room_id': room_id})
+            raise
+        # 3
+        echo_waiter = AsyncResult()
+        if locked:
+            self.echo_waiters[new_message.pk] = echo_waiter
+        event = serialize_message(new_message.pk, new_message)
+        event.update(type='message', room_id=room_id, locked=locked)
+        sent = self.send(event)
+        # 4
+        if not (locked and sent and self.wait_for_broker(echo_waiter)):
+            self.echo_waiters.pop(new_message.pk, None)
+            sender.get_messages_queue(room_id).append(
+                (new_message.pk, MessageRecord.from_message(new_message)))
+            sender.signal_new_message_event(room_id)
+        # 5
+        return new_message
+
+    def handle_presence(self, chatobj, room_id, username):
+        """Sends the user to the other workers """
+        self.start_receiver(chatobj)
+        self.send({'type': 'presence',
+                   'room_id': room_id,
+                   'username': username})
+
+    def get_latest_message_id(self, chatobj, room_id):
+        """Returns id of the latest message received """
+        self.start_receiver(chatobj)
+        return super(BrokerMessageHandler, self).get_latest_message_id(
+                    chatobj, room_id)
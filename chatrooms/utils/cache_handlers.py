@@ -0,0 +1,329 @@
+#encoding=utf8
+import time
+import uuid
+
+import gevent
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models import Max
+
+from .handlers import MessageHandler
+from .messagelog import EncodedMessage, MessageBatch, MessageRecord
+from .queries import get_latest_messages_by_room
+from .serializers import encode_message
+from ..models import Message
+
+
+CACHE_ALIAS = getattr(settings, 'CHATROOMS_CACHE_ALIAS', 'default')
+
+CACHE_WAIT_TIMEOUT = getattr(settings, 'CHATROOMS_CACHE_WAIT_TIMEOUT', 20)
+
+CACHE_MESSAGES_SIZE = getattr(settings, 'CHATROOMS_CACHE_MESSAGES_SIZE', 50)
+
+# seconds between two checks of the version keys of the rooms
+CACHE_POLL_INTERVAL = getattr(settings, 'CHATROOMS_CACHE_POLL_INTERVAL', 0.5)
+
+# expiry of the cache keys, in seconds
+CACHE_TIMEOUT = getattr(settings, 'CHATROOMS_CACHE_TIMEOUT', 86400)
+
+# seconds a room lock is held at most, should its holder die
+CACHE_LOCK_TIMEOUT = getattr(settings, 'CHATROOMS_CACHE_LOCK_TIMEOUT', 5)
+
+# seconds between two attempts to take a room lock
+CACHE_LOCK_INTERVAL = 0.01
+
+KEY_PREFIX = 'chatrooms:room:'
+
+
+class CacheMessageHandler(MessageHandler):
+    """Custom MessageHandler class using the django cache framework
+    (settings.CHATROOMS_CACHE_ALIAS) for synchronization
+
+    Each message of a room gets a sequence number, by an atomic
+    increment of the room version key, and is stored as a JSON fragment
+    under the key of its sequence number: the latest messages of the
+    room (settings.CHATROOMS_CACHE_MESSAGES_SIZE) are read by a single
+    get_many, and db is read only for messages older than them, or
+    if some of them have been evicted from the cache.
+    Messages of a room are saved and stored one at a time, holding a
+    lock stored in cache (see self.lock_room), so that the order of
+    their sequence numbers is the order of their ids: clients which
+    got a message don't miss the ones preceding it.
+    The connected users of each room are stored along with the time they
+    were last seen, and counted by a users version key.
+
+    A single poller greenlet per process reads the version keys of the
+    rooms which have waiting requests every
+    settings.CHATROOMS_CACHE_POLL_INTERVAL seconds, by a single
+    get_many, and wakes up the requests when they change.
+    """
+    def __init__(self, cache=None):
+        """Initializes the cache backend """
+        self.cache = cache or get_cache(CACHE_ALIAS)
+        self.poller = None
+        # values of the version keys the poller signaled
+        self.versions = {}
+        # (sequence number, latest messages) by room id
+        self.windows = {}
+
+    def get_sequence_key(self, room_id):
+        """Returns the key of the sequence number of the latest message """
+        return '%s%s:seq' % (KEY_PREFIX, room_id)
+
+    def get_message_key(self, room_id, seq):
+        """Returns the key of the message with sequence number seq """
+        return '%s%s:message:%d' % (KEY_PREFIX, room_id, seq)
+
+    def get_users_key(self, room_id):
+        """Returns the key of the connected users """
+        return '%s%s:users' % (KEY_PREFIX, room_id)
+
+    def get_users_version_key(self, room_id):
+        """Returns the key of the version of the connected users """
+        return '%s%s:users_version' % (KEY_PREFIX, room_id)
+
+    def get_lock_key(self, room_id):
+        """Returns the key of the lock of the room """
+        return '%s%s:lock' % (KEY_PREFIX, room_id)
+
+    def lock_room(self, room_id):
+        """Waits for the lock of a room, which expires after
+        settings.CHATROOMS_CACHE_LOCK_TIMEOUT seconds should its holder
+        die before releasing it
+        Returns the token to release the lock with
+
+        """
+        key = self.get_lock_key(room_id)
+        token = uuid.uuid4().hex
+        while not self.cache.add(key, token, CACHE_LOCK_TIMEOUT):
+            gevent.sleep(CACHE_LOCK_INTERVAL)
+        return token
+
+    def unlock_room(self, room_id, token):
+        """Releases the lock of a room, unless it expired """
+        key = self.get_lock_key(room_id)
+        if self.cache.get(key) == token:
+            self.cache.delete(key)
+
+    def increment(self, key):
+        """Increments a counter key, creating it if needed
+        Returns the new value
+
+        """
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            self.cache.add(key, 0, CACHE_TIMEOUT)
+            return self.cache.incr(key)
+
+    def load_room(self, room_id):
+        """Stores in cache the latest messages of a room read from db,
+        unless another process did it in the meantime
+        Returns True if the messages have been stored
+
+        """
+        records = get_latest_messages_by_room(
+                        [room_id], CACHE_MESSAGES_SIZE)[room_id]
+        seq_key = self.get_sequence_key(room_id)
+        if not self.cache.add(seq_key, len(records), CACHE_TIMEOUT):
+            return False
+        self.cache.set_many(dict(
+            (self.get_message_key(room_id, seq),
+             (record.id, encode_message(record.id, record)))
+            for seq, record in enumerate(records, 1)), CACHE_TIMEOUT)
+        return True
+
+    def store_message(self, room_id, message):
+        """Stores a saved message among the latest messages of a room
+        If the room isn't in cache, its latest messages are read from db,
+        including the message, which isn't stored again
+
+        """
+        seq_key = self.get_sequence_key(room_id)
+        if self.cache.get(seq_key) is None and self.load_room(room_id):
+            return
+        seq = self.increment(seq_key)
+        self.cache.set(self.get_message_key(room_id, seq),
+                       (message.pk, encode_message(message.pk, message)),
+                       CACHE_TIMEOUT)
+
+    def get_window(self, room_id):
+        """
+        Returns a tuple (messages, complete) where messages is the list
+        of the latest (message_id, fragment) tuples stored in cache,
+        sorted by id, and complete is False if some of them are missing,
+        having been evicted or being stored by another process.
+        Messages stored twice, by processes loading the room from db
+        concurrently, are returned once.
+        Complete lists are memoized by the sequence number of the room.
+
+        """
+        seq_key = self.get_sequence_key(room_id)
+        seq = self.cache.get(seq_key)
+        if seq is None:
+            self.load_room(room_id)
+            seq = self.cache.get(seq_key) or 0
+        window = self.windows.get(room_id)
+        if window is not None and window[0] == seq:
+            return window[1], True
+        keys = [self.get_message_key(room_id, number) for number in
+                xrange(max(seq - CACHE_MESSAGES_SIZE, 0) + 1, seq + 1)]
+        stored = self.cache.get_many(keys)
+        complete = len(stored) == len(keys)
+        messages = sorted(dict(stored.values()).iteritems())
+        if complete:
+            self.windows[room_id] = (seq, messages)
+        return messages, complete
+
+    def start_poller(self, chatobj):
+        """Spawns the poller greenlet, unless it's running """
+        if self.poller is None or self.poller.dead:
+            self.poller = gevent.spawn(self.poll, chatobj)
+
+    def poll(self, chatobj):
+        """
+        Reads the version keys of the rooms with waiting requests,
+        signaling new_message_event on chatobj when the sequence number
+        of a room changes, and merging the connected users of a room
+        when their version changes (see self.merge_users)
+
+        """
+        while True:
+            gevent.sleep(CACHE_POLL_INTERVAL)
+            keys = {}
+            for room_id, waiters in chatobj.waiters.items():
+                if waiters:
+                    keys[self.get_sequence_key(room_id)] = (True, room_id)
+                    keys[self.get_users_version_key(room_id)] = (
+                                                        False, room_id)
+            if not keys:
+                continue
+            for key, value in self.cache.get_many(keys).iteritems():
+                if self.versions.get(key) == value:
+                    continue
+                self.versions[key] = value
+                is_sequence, room_id = keys[key]
+                if is_sequence:
+                    chatobj.signal_new_message_event(room_id)
+                else:
+                    self.merge_users(chatobj, room_id)
+
+    def merge_users(self, chatobj, room_id):
+        """Keeps the users stored in cache by other processes among the
+        connected users of a room, signaling new_connected_user_event
+        if some of them joined
+
+        """
+        presence = chatobj.connected_users.get(room_id)
+        if presence is None:
+            return
+        now = time.time()
+        joined = False
+        users = self.cache.get(self.get_users_key(room_id)) or {}
+        for username, last_seen in users.iteritems():
+            if now - last_seen > chatobj.presence_timeout:
+                continue
+            if username not in presence or (
+                    presence.users[username] < last_seen):
+                joined = presence.touch(username) or joined
+        if joined:
+            chatobj.signal_new_connected_user_event(room_id)
+
+    def handle_received_message(self,
+        sender, room_id, username, message, date, **kwargs):
+        """
+        1. saves the message
+        2. stores the message among the latest room messages in cache
+        1 and 2 hold the room lock (see self.lock_room)
+        3. signals new_message_event on sender: the pollers of the
+        other processes find the new sequence number of the room
+
+        """
+        token = self.lock_room(room_id)
+        try:
+            # 1
+            new_message = self.create_message(
+                        room_id, username, message, date, **kwargs)
+
+            # 2
+            self.store_message(room_id, new_message)
+        finally:
+            self.unlock_room(room_id, token)
+
+        # 3
+        sender.signal_new_message_event(room_id)
+        return new_message
+
+    def handle_presence(self, chatobj, room_id, username):
+        """Stores the user among the connected users of the room in
+        cache, dropping the ones not seen for chatobj.presence_timeout
+        seconds, and bumps their version
+
+        """
+        now = time.time()
+        users_key = self.get_users_key(room_id)
+        users = dict(
+            (name, last_seen) for name, last_seen
+            in (self.cache.get(users_key) or {}).iteritems()
+            if now - last_seen <= chatobj.presence_timeout)
+        users[username] = now
+        self.cache.set(users_key, users, CACHE_TIMEOUT)
+        self.increment(self.get_users_version_key(room_id))
+
+    def retrieve_messages(self, chatobj, room_id, latest_msg_id, **kwargs):
+        """
+        1. waits for a message of the room, at most the timeout given
+        by keyword or settings.CHATROOMS_CACHE_WAIT_TIMEOUT seconds,
+        unless the room already received messages following
+        latest_msg_id
+        2. returns the messages following latest_msg_id stored in cache,
+        reading from db the ones older than the messages kept by the
+        cache, or all of them if some are missing from the cache
+
+        """
+        self.start_poller(chatobj)
+        # 1
+        chatobj.wait_for_new_message(
+            room_id, latest_msg_id,
+            timeout=kwargs.get('timeout', CACHE_WAIT_TIMEOUT))
+        # 2
+        window, complete = self.get_window(room_id)
+        if complete and (len(window) < CACHE_MESSAGES_SIZE or
+                         window[0][0] <= latest_msg_id):
+            stored = [(msg_id, fragment) for msg_id, fragment in window
+                      if msg_id > latest_msg_id]
+            return MessageBatch(
+                [(msg_id, EncodedMessage(fragment))
+                 for msg_id, fragment in stored],
+                [fragment for msg_id, fragment in stored])
+        return MessageBatch(
+            (fields[0], MessageRecord(*fields))
+            for fields in Message.objects.filter(
+                room=room_id, pk__gt=latest_msg_id,
+            ).order_by('pk').values_list(
+                'id', 'username', 'date', 'content',
+            )[:CACHE_MESSAGES_SIZE])
+
+    def load_latest_messages(self, chatobj, room_ids):
+        """Messages are read from cache on each request: rooms messages
+        queues aren't used
+
+        """
+        pass
+
+    def get_latest_message_id(self, chatobj, room_id):
+        """Returns id of the latest message received, reading it from db
+        if some of the latest messages are missing from the cache
+
+        """
+        self.start_poller(chatobj)
+        window, complete = self.get_window(room_id)
+        if not complete:
+            latest_msg_id = Message.objects.filter(
+                            room=room_id).aggregate(
+                            max_id=Max('id')).get('max_id')
+            return latest_msg_id or -1
+        if not window:
+            return -1
+        return window[-1][0]
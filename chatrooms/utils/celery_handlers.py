@@ -1,26 +1,84 @@
 #encoding=utf8
-
+import gevent
 from celery.app import app_or_default
-from celery.events import Event
 
+from django.conf import settings
 from django.db.models import Max
 
 from .handlers import MessageHandler
-from ..models import Room, Message
+from .polymorphism import read_queryset
+from .rooms import room_cache
+from ..models import Message
+
+
+CELERY_WAIT_TIMEOUT = getattr(settings, 'CHATROOMS_CELERY_WAIT_TIMEOUT', 20)
+
+EVENT_TYPE = 'chatrooms-message'
 
 
 class CeleryMessageHandler(MessageHandler):
     """Custom MessageHandler class using celery
     for synchronization
+
+    Each message sends a celery event carrying its room id and message id.
+    A single receiver greenlet per process captures the events, keeps the
+    id of the latest message of each room, and wakes up the requests
+    waiting on the ChatView room events.
     """
-    def __init__(self):
-        """Initializes celery events and dispatchers
+    def __init__(self, app=None):
+        """Initializes celery events dispatcher
         """
-        self.app = app_or_default()
-        self.event = Event(type='chatrooms')
+        self.app = app or app_or_default()
         self.dispatcher = self.app.events.Dispatcher(
-                            connection=self.app.broker_connection(),
+                            connection=self.app.connection(),
                             enabled=True)
+        self.receiver = None
+        self.latest_message_ids = {}
+
+    def start_receiver(self, chatobj):
+        """Spawns the receiver greenlet, unless it's running """
+        if self.receiver is None or self.receiver.dead:
+            self.receiver = gevent.spawn(self.listen, chatobj)
+
+    def listen(self, chatobj):
+        """
+        Captures the chatrooms events and calls self.on_message_event
+        for each of them.
+        On connection errors, forgets the latest message ids, which
+        are read again from db, and wakes up all the waiting requests,
+        which might have missed a message, then connects again.
+
+        """
+        def handler(event):
+            self.on_message_event(chatobj, event)
+
+        while True:
+            connection = self.app.connection()
+            try:
+                receiver = self.app.events.Receiver(
+                            connection, handlers={EVENT_TYPE: handler})
+                receiver.capture(limit=None, timeout=None, wakeup=False)
+            except connection.connection_errors:
+                self.latest_message_ids.clear()
+                for room_id in chatobj.new_message_events.keys():
+                    chatobj.signal_new_message_event(room_id)
+                gevent.sleep(1)
+            finally:
+                connection.release()
+
+    def on_message_event(self, chatobj, event):
+        """Updates the latest message id of the event room and
+        signals new_message_event on chatobj
+
+        """
+        room_id = event['room_id']
+        self.update_latest_message_id(room_id, event['message_id'])
+        chatobj.signal_new_message_event(room_id)
+
+    def update_latest_message_id(self, room_id, msg_id):
+        """Keeps the greatest message id received by a room """
+        if msg_id > self.latest_message_ids.get(room_id, -1):
+            self.latest_message_ids[room_id] = msg_id
 
     def handle_received_message(self,
         sender, room_id, username, message, date, **kwargs):
@@ -30,9 +88,9 @@ class CeleryMessageHandler(MessageHandler):
 
         """
 
-        room = Room.objects.get(id=room_id)
+        room = room_cache.get(pk=room_id)
         fields = {
-            'room': room,
+            'room_id': room.id,
             'date': date,
             'content': message,
             'username': username,
@@ -45,34 +103,51 @@ class CeleryMessageHandler(MessageHandler):
         new_message.save()
 
         # 2
-        self.dispatcher.send(type='chatrooms')
+        self.update_latest_message_id(room_id, new_message.pk)
+        self.dispatcher.send(type=EVENT_TYPE,
+                             room_id=room_id,
+                             message_id=new_message.pk)
 
     def retrieve_messages(self, chatobj, room_id, latest_msg_id, **kwargs):
         """
-        1. waits for "chatrooms" event
-        2. returns the messages with id greater than latest_msg_id
+        1. waits for a message event of the room, at most the timeout
+        given by keyword or settings.CHATROOMS_CELERY_WAIT_TIMEOUT
+        seconds, unless the room already received messages following
+        latest_msg_id
+        2. returns the messages with id greater than latest_msg_id,
+        at most chatobj.messages_log_size of them: the client gets
+        the remaining ones with its next requests
 
         """
-        def handler(*args, **kwargs):
-            pass
-
-        receiver = self.app.events.Receiver(
-                    connection=self.app.broker_connection(),
-                    handlers={"chatrooms": handler, })
-        try:
-            # 1
-            receiver.capture(limit=1, timeout=20, wakeup=True)
-        except:  # Timeout
-            pass
+        self.start_receiver(chatobj)
+        # 1
+        chatobj.wait_for_new_message(
+            room_id, latest_msg_id,
+            timeout=kwargs.get('timeout', CELERY_WAIT_TIMEOUT))
         # 2
-        messages = Message.objects.filter(room=room_id, id__gt=latest_msg_id)
+        if self.get_latest_message_id(chatobj, room_id) <= latest_msg_id:
+            return []
+        messages = read_queryset(
+                    Message.objects.filter(room=room_id, id__gt=latest_msg_id)
+                    ).order_by('pk')[:chatobj.messages_log_size]
         return [(msg.pk, msg) for msg in messages]
 
+    def load_latest_messages(self, chatobj, room_ids):
+        """Messages are read from db on each request: rooms messages
+        queues aren't used
+
+        """
+        pass
+
     def get_latest_message_id(self, chatobj, room_id):
-        """Returns id of the latest message received """
-        latest_msg_id = Message.objects.filter(
-                        room=room_id).aggregate(
-                        max_id=Max('id')).get('max_id')
-        if not latest_msg_id:
-            latest_msg_id = -1
-        return latest_msg_id
+        """Returns id of the latest message received, kept up to date
+        by the message events once it's been read from db
+
+        """
+        self.start_receiver(chatobj)
+        if room_id not in self.latest_message_ids:
+            latest_msg_id = Message.objects.filter(
+                            room=room_id).aggregate(
+                            max_id=Max('id')).get('max_id')
+            self.latest_message_ids.setdefault(room_id, latest_msg_id or -1)
+        return self.latest_message_ids[room_id]
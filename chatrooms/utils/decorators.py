@@ -6,12 +6,12 @@ from django.core.urlresolvers import reverse
 from django.http import (HttpResponse,
                          HttpResponseForbidden,
                          HttpResponseRedirect)
-from django.shortcuts import render_to_response, get_object_or_404
+from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.utils.decorators import available_attrs
 from django.utils.functional import wraps
 
-from ..models import Room
+from .rooms import get_room_or_404
 
 
 def ajax_user_passes_test_or_403(test_func, message="Access denied"):
@@ -50,7 +50,7 @@ def ajax_room_login_required(view_func):
     def _wrapped_view(request, *args, **kwargs):
         room_id = request.REQUEST.get('room_id')
         if room_id:
-            room = get_object_or_404(Room, pk=room_id)
+            room = get_room_or_404(pk=room_id)
             if room.allow_anonymous_access:
                 return view_func(request, *args, **kwargs)
         if request.is_ajax():
@@ -77,7 +77,7 @@ def room_check_access(view_func):
     @wraps(view_func, assigned=available_attrs(view_func))
     def _wrapped_view(request, *args, **kwargs):
         room_slug = kwargs.get('slug')
-        room = get_object_or_404(Room, slug=room_slug)
+        room = get_room_or_404(slug=room_slug)
         if request.user.is_authenticated():
             return view_func(request, *args, **kwargs)
         elif room.allow_anonymous_access:
@@ -103,9 +103,18 @@ def signals_new_message_at_end(func):
 
 def waits_for_new_message_at_start(func):
     """Decorator for MessageHandler.retrieve_messages method
+    Doesn't wait if the room already holds messages following
+    latest_msg_id, waits at most the timeout given by keyword, if any
+    Returns no messages if the room has been dropped while waiting,
+    instead of allocating it again
     """
     @wraps(func, assigned=available_attrs(func))
-    def _wrapper(self, chatobj, room_id, *args, **kwargs):
-        chatobj.wait_for_new_message(room_id)
-        return func(self, chatobj, room_id, *args, **kwargs)
+    def _wrapper(self, chatobj, room_id, latest_msg_id, *args, **kwargs):
+        wait_kwargs = {}
+        if 'timeout' in kwargs:
+            wait_kwargs['timeout'] = kwargs['timeout']
+        chatobj.wait_for_new_message(room_id, latest_msg_id, **wait_kwargs)
+        if room_id not in chatobj.last_activity:
+            return []
+        return func(self, chatobj, room_id, latest_msg_id, *args, **kwargs)
     return _wrapper
@@ -1,12 +1,35 @@
 #encoding=utf8
+import atexit
+import logging
+import time
+from collections import deque
+from itertools import islice
+
+import gevent
+from gevent.event import Event
+from gevent.lock import Semaphore
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Max
 from django_load.core import load_object
 
 from .decorators import (signals_new_message_at_end,
                         waits_for_new_message_at_start)
-from ..models import Room, Message
+from .messagelog import MessageBatch, MessageLog, MessageRecord
+from .queries import get_latest_messages_by_room
+from .rooms import room_cache
+from ..models import Message
+
+
+WRITE_BEHIND_BATCH_SIZE = getattr(settings,
+                                  'CHATROOMS_WRITE_BEHIND_BATCH_SIZE', 100)
+
+WRITE_BEHIND_INTERVAL = getattr(settings,
+                                'CHATROOMS_WRITE_BEHIND_INTERVAL', 1)
+
+logger = logging.getLogger(__name__)
 
 
 class MessageHandler(object):
@@ -23,28 +46,30 @@ class MessageHandler(object):
 
     These methods are responsible for long polling implementation:
     ``retrieve_messages`` waits for new_message_event at its start,
+    unless the room already received messages the client hasn't got,
     ``handle_received_message`` signals new_message_event at its end.
 
     The handlers can be customized and replaced extending this class
     and setting the full path name of the extending class
     into settings.CHATROOMS_HANDLERS_CLASS
     """
+    # locks held while saving and queueing a message, by room id
+    room_locks = None
 
-    @signals_new_message_at_end
-    def handle_received_message(self,
-        sender, room_id, username, message, date, **kwargs):
-        """
-        Default handler for the message_received signal.
-        1 - Saves an instance of message to db
-        2 - Appends a tuple (message_id, message_obj)
-            to the sender.messages queue
-        3 - Signals the "New message" event on the sender (decorator)
-        4 - Returns the created message
+    def get_room_lock(self, room_id):
+        """Returns the lock of a room, creating it if needed """
+        if self.room_locks is None:
+            self.room_locks = {}
+        lock = self.room_locks.get(room_id)
+        if lock is None:
+            lock = self.room_locks[room_id] = Semaphore()
+        return lock
 
-        """
-        room = Room.objects.get(id=room_id)
+    def create_message(self, room_id, username, message, date, **kwargs):
+        """Saves and returns an instance of message """
+        room = room_cache.get(pk=room_id)
         fields = {
-            'room': room,
+            'room_id': room.id,
             'date': date,
             'content': message,
             'username': username,
@@ -52,14 +77,36 @@ class MessageHandler(object):
         user = kwargs.get('user')
         if user:
             fields['user'] = user
-        # 1
         new_message = Message(**fields)
         new_message.save()
+        return new_message
 
-        # 2
-        msg_number = sender.get_next_message_id(room_id)
-        messages_queue = sender.get_messages_queue(room_id)
-        messages_queue.append((msg_number, new_message))
+    @signals_new_message_at_end
+    def handle_received_message(self,
+        sender, room_id, username, message, date, **kwargs):
+        """
+        Default handler for the message_received signal.
+        1 - Saves an instance of message to db
+        2 - Appends a tuple (message_id, message_record)
+            to the sender.messages queue, where message_record
+            is a compact MessageRecord copy of the message and
+            message_id is its primary key
+            1 and 2 hold the room lock: inserts of concurrent greenlets
+            may complete out of order with cooperative db drivers, and
+            messages must be queued in the order of their ids
+        3 - Signals the "New message" event on the sender (decorator)
+        4 - Returns the created message
+
+        """
+        with self.get_room_lock(room_id):
+            # 1
+            new_message = self.create_message(
+                        room_id, username, message, date, **kwargs)
+
+            # 2
+            messages_queue = sender.get_messages_queue(room_id)
+            messages_queue.append(
+                (new_message.pk, MessageRecord.from_message(new_message)))
 
         # 3 - decorator does
         # sender.signal_new_message_event(room_id)
@@ -75,26 +122,311 @@ class MessageHandler(object):
         Where message_obj is an instance of Message or an object with
         the attributes 'username', 'date' and 'content' at least
 
-        1 - Waits for new_message_event (decorator)
-        2 - returns the queue of messages stored in
-        the ChatView.message dictionary by self.handle_received_message
+        1 - Waits for new_message_event if there are no messages
+            following latest_msg_id (decorator)
+        2 - returns the messages following latest_msg_id stored in
+        the ChatView.messages dictionary by self.handle_received_message,
+        reading from db the ones already dropped from the queue
 
         """
         # 1 - decorator does
-        # chatobj.wait_for_new_message(room_id)
+        # chatobj.wait_for_new_message(room_id, latest_msg_id)
 
         # 2
-        return chatobj.get_messages_queue(room_id)
+        messages_queue = chatobj.get_messages_queue(room_id)
+        if not messages_queue.holds_messages_since(latest_msg_id):
+            return self.retrieve_dropped_messages(
+                        chatobj, room_id, latest_msg_id)
+        return messages_queue.since(latest_msg_id)
+
+    def retrieve_dropped_messages(self, chatobj, room_id, latest_msg_id):
+        """
+        Returns the messages following latest_msg_id which have been
+        dropped from the room messages queue, reading them from db.
+
+        Message ids are primary keys, so the dropped messages are the
+        ones with ids between latest_msg_id and the oldest id in the queue.
+        At most a queue capacity of messages is returned: the client
+        gets the remaining ones with its next requests.
+
+        """
+        messages_queue = chatobj.get_messages_queue(room_id)
+        filters = {'room': room_id, 'pk__gt': latest_msg_id}
+        if messages_queue:
+            filters['pk__lt'] = messages_queue.oldest_id
+        dropped = Message.objects.filter(**filters).order_by(
+                        'pk').values_list(
+                        'id', 'username', 'date', 'content',
+                  )[:messages_queue.capacity]
+        messages = MessageBatch(
+            (fields[0], MessageRecord(*fields)) for fields in dropped)
+        if len(messages) < messages_queue.capacity:
+            messages.extend(messages_queue.since(latest_msg_id))
+        return messages
+
+    def load_latest_messages(self, chatobj, room_ids):
+        """
+        Fills the messages queues of the given rooms with their
+        latest messages read from db, by one query
+        Messages received by the rooms in the meantime are kept
+
+        """
+        latest_messages = get_latest_messages_by_room(
+                            room_ids, chatobj.messages_log_size)
+        for room_id, records in latest_messages.iteritems():
+            messages_queue = MessageLog(chatobj.messages_log_size)
+            for record in records:
+                messages_queue.append((record.id, record))
+            if len(records) == messages_queue.capacity:
+                # older messages may be found in db
+                messages_queue.last_dropped_id = records[0].id - 1
+            for entry in chatobj.get_messages_queue(room_id):
+                messages_queue.append(entry)
+            chatobj.messages[room_id] = messages_queue
+
+    def handle_presence(self, chatobj, room_id, username):
+        """Called when username joins a room or is seen again, as
+        counted by the version of the room connected users: connected
+        users are kept by chatobj, in process
+
+        """
+        pass
 
     def get_latest_message_id(self, chatobj, room_id):
-        """Returns id of the latest message received """
+        """Returns id of the latest message received
+        It's called by requests about to wait for the room messages:
+        handlers listening to other processes start their listener
+        here, so that messages sent in the meantime wake them up
+
+        """
         latest_msg_id = -1
-        msgs_queue = chatobj.messages[room_id]
+        msgs_queue = chatobj.get_messages_queue(room_id)
         if msgs_queue:
-            latest_msg_id = msgs_queue[-1][0]
+            latest_msg_id = msgs_queue.head_id
         return latest_msg_id
 
 
+class WriteBehindMessageHandler(MessageHandler):
+    """
+    MessageHandler which publishes the received messages to the rooms
+    messages queues before they're saved, so that message delivery
+    doesn't wait for db writes.
+
+    Received messages are queued and saved by a background greenlet,
+    by one bulk insert for each batch of
+    settings.CHATROOMS_WRITE_BEHIND_BATCH_SIZE messages (100 by default),
+    at least every settings.CHATROOMS_WRITE_BEHIND_INTERVAL seconds
+    (1 by default). The queued messages are saved on process exit as well.
+
+    Message ids are assigned by the handler, following the greatest
+    message id found in db, and used as primary keys of the saved
+    messages: the handler must be the only writer of messages, running
+    in a single process. On PostgreSQL, where inserts with explicit
+    primary keys don't advance the sequence of the table, ids are
+    reserved from the sequence by blocks of batch_size, so that
+    messages created otherwise don't reuse them.
+    """
+    def __init__(self, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                 interval=WRITE_BEHIND_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        # (message, time it has been queued at) tuples, sorted by id
+        self.pending = deque()
+        self.latest_id = None
+        # ids reserved from the sequence of the table, on PostgreSQL
+        self.reserved_ids = deque()
+        self.flusher = None
+        self.batch_ready = Event()
+        self.flush_lock = Semaphore()
+        atexit.register(self.flush_all)
+
+    def next_message_id(self):
+        """Returns the id of the next message """
+        if connection.vendor == 'postgresql':
+            if not self.reserved_ids:
+                self.reserve_message_ids()
+            self.latest_id = self.reserved_ids.popleft()
+            return self.latest_id
+        if self.latest_id is None:
+            self.latest_id = Message.objects.aggregate(
+                                max_id=Max('id')).get('max_id') or 0
+        self.latest_id += 1
+        return self.latest_id
+
+    def reserve_message_ids(self):
+        """Reserves self.batch_size ids from the PostgreSQL sequence of
+        the messages table, by one query
+
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id'))"
+            " FROM generate_series(1, %s)",
+            [Message._meta.db_table, self.batch_size])
+        self.reserved_ids.extend(sorted(row[0] for row in cursor.fetchall()))
+
+    @signals_new_message_at_end
+    def handle_received_message(self,
+        sender, room_id, username, message, date, **kwargs):
+        """
+        1 - Creates an instance of message with the next message id
+        2 - Appends a tuple (message_id, message_record)
+            to the sender.messages queue
+        3 - Queues the message to be saved, waking up the flusher
+            if a batch is ready
+        4 - Signals the "New message" event on the sender (decorator)
+        5 - Returns the created message
+
+        """
+        room = room_cache.get(pk=room_id)
+        fields = {
+            'room_id': room.id,
+            'date': date,
+            'content': message,
+            'username': username,
+        }
+        user = kwargs.get('user')
+        if user:
+            fields['user'] = user
+        # 1
+        new_message = Message(pk=self.next_message_id(), **fields)
+        new_message.pre_save_polymorphic()
+
+        # 2
+        messages_queue = sender.get_messages_queue(room_id)
+        messages_queue.append(
+                    (new_message.pk, MessageRecord.from_message(new_message)))
+
+        # 3
+        self.pending.append((new_message, time.time()))
+        self.start_flusher()
+        if len(self.pending) >= self.batch_size:
+            self.batch_ready.set()
+
+        # 4 - decorator does
+        # sender.signal_new_message_event(room_id)
+
+        # 5
+        return new_message
+
+    def start_flusher(self):
+        """Spawns the flusher greenlet, unless it's running """
+        if self.flusher is None or self.flusher.dead:
+            self.flusher = gevent.spawn(self.run_flusher)
+
+    def run_flusher(self):
+        """
+        Saves the queued messages whenever a batch is ready or
+        self.interval seconds have passed.
+        Messages which failed to be saved are kept queued and
+        saved on the next run, unless they can't be saved at all
+        (see self.flush).
+
+        """
+        while True:
+            self.batch_ready.wait(self.interval)
+            self.batch_ready.clear()
+            try:
+                self.flush_all()
+            except DatabaseError:
+                logger.exception("Unable to save %d queued chat messages",
+                                 len(self.pending))
+
+    def flush(self):
+        """Saves a batch of queued messages by one query, or one by one
+        if the batch breaks an integrity constraint (see self.save_each)
+        Returns the number of messages taken from the queue
+
+        """
+        with self.flush_lock:
+            batch = [message for message, queued_at
+                     in islice(self.pending, self.batch_size)]
+            if batch:
+                try:
+                    Message.objects.bulk_create(batch)
+                except IntegrityError:
+                    self.save_each(batch)
+                for message in batch:
+                    self.pending.popleft()
+            return len(batch)
+
+    def save_each(self, batch):
+        """Saves the messages of a batch one by one, dropping the ones
+        which break an integrity constraint, as their room has been
+        deleted or their id has been taken by another writer
+
+        """
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create([message])
+            except IntegrityError:
+                logger.exception("Dropping chat message %s, which can't "
+                                 "be saved", message.pk)
+
+    def flush_all(self):
+        """Saves all the queued messages """
+        while self.flush():
+            pass
+
+    def get_pending_count(self):
+        """Returns the number of messages waiting to be saved """
+        return len(self.pending)
+
+    def get_write_lag(self):
+        """Returns the number of seconds the oldest message waiting
+        to be saved has been queued for
+
+        """
+        if not self.pending:
+            return 0
+        return time.time() - self.pending[0][1]
+
+    def get_pending_messages(self, room_id, latest_msg_id):
+        """Returns (message_id, message_record) tuples of the messages
+        of a room following latest_msg_id which haven't been saved yet
+
+        """
+        return [(message.pk, MessageRecord.from_message(message))
+                for message, queued_at in list(self.pending)
+                if message.room_id == room_id and message.pk > latest_msg_id]
+
+    def retrieve_dropped_messages(self, chatobj, room_id, latest_msg_id):
+        """
+        Returns the messages following latest_msg_id which have been
+        dropped from the room messages queue, reading them from db and
+        from the messages waiting to be saved
+
+        """
+        messages = super(WriteBehindMessageHandler,
+                         self).retrieve_dropped_messages(
+                            chatobj, room_id, latest_msg_id)
+        pending = self.get_pending_messages(room_id, latest_msg_id)
+        if not pending:
+            return messages
+        known_ids = set(msg_id for msg_id, message in messages)
+        merged = sorted(list(messages) + [entry for entry in pending
+                                          if entry[0] not in known_ids],
+                        key=lambda entry: entry[0])
+        capacity = chatobj.get_messages_queue(room_id).capacity
+        return MessageBatch(merged[:capacity])
+
+    def load_latest_messages(self, chatobj, room_ids):
+        """
+        Fills the messages queues of the given rooms with their latest
+        messages read from db, along with the ones waiting to be saved
+
+        """
+        super(WriteBehindMessageHandler, self).load_latest_messages(
+                            chatobj, room_ids)
+        for room_id in room_ids:
+            messages_queue = chatobj.messages.get(room_id)
+            if messages_queue is None:
+                continue
+            for entry in self.get_pending_messages(room_id, -1):
+                messages_queue.append(entry)
+
+
 class MessageHandlerFactory(object):
     """
     Returns a (singleton) instance of the class set as
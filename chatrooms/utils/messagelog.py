@@ -0,0 +1,232 @@
+#encoding=utf8
+import json
+from datetime import datetime
+
+from .serializers import TIME_FORMAT, encode_message
+
+
+class MessageRecord(object):
+    """
+    Compact and immutable copy of a Message instance, holding only
+    the fields sent to clients: rooms message logs store records
+    instead of model instances, which carry their state, cached
+    relations and polymorphic attributes.
+
+    """
+    __slots__ = ('id', 'username', 'date', 'content')
+
+    def __init__(self, id, username, date, content):
+        for name, value in zip(self.__slots__,
+                               (id, username, date, content)):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_message(cls, message):
+        """Returns the record of a Message instance """
+        return cls(message.pk, message.username,
+                   message.date, message.content)
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MessageRecord objects are immutable")
+
+    def __repr__(self):
+        return '<MessageRecord %s: %s>' % (self.id, self.username)
+
+
+class EncodedMessage(object):
+    """Message read from a shared store (redis, cache) as a JSON fragment,
+    which is decoded only if its attributes are accessed
+
+    """
+    __slots__ = ('fragment', '_record')
+
+    def __init__(self, fragment):
+        self.fragment = fragment
+        self._record = None
+
+    def get_record(self):
+        """Returns the MessageRecord decoded from the fragment """
+        if self._record is None:
+            fields = json.loads(self.fragment)
+            self._record = MessageRecord(
+                fields['message_id'], fields['username'],
+                datetime.strptime(fields['date'], TIME_FORMAT),
+                fields['content'])
+        return self._record
+
+    id = property(lambda self: self.get_record().id)
+    pk = id
+    username = property(lambda self: self.get_record().username)
+    date = property(lambda self: self.get_record().date)
+    content = property(lambda self: self.get_record().content)
+
+
+class MessageBatch(list):
+    """
+    List of (message_id, message_obj) tuples which carries the JSON
+    fragment of each message in its ``fragments`` attribute.
+    Fragments are encoded on creation unless they are given.
+
+    """
+    def __init__(self, messages=(), fragments=None):
+        super(MessageBatch, self).__init__(messages)
+        if fragments is None:
+            fragments = [encode_message(msg_id, message)
+                         for msg_id, message in self]
+        self.fragments = list(fragments)
+
+    def extend(self, messages):
+        """Extends the batch with the messages of another batch """
+        if not isinstance(messages, MessageBatch):
+            messages = MessageBatch(messages)
+        super(MessageBatch, self).extend(messages)
+        self.fragments.extend(messages.fragments)
+
+
+class MessageLog(object):
+    """
+    Fixed-capacity ring buffer holding the latest messages of a room
+    as (message_id, message_obj) tuples, sorted by message_id.
+    Each message is stored along with its JSON fragment, encoded once
+    when the message is appended.
+
+    Message ids must be appended in increasing order, which allows
+    the log to find the messages following a given id by bisection
+    instead of scanning every entry.
+    When the log is full, appending a message drops the oldest one:
+    ``last_dropped_id`` keeps track of the latest id rolled out of
+    the log, so that callers can tell whether the log still holds
+    every message following a given id.
+
+    """
+    def __init__(self, capacity=50):
+        if capacity < 1:
+            raise ValueError("MessageLog capacity must be a positive integer")
+        self.capacity = capacity
+        self.last_dropped_id = None
+        self._ids = [None] * capacity
+        self._messages = [None] * capacity
+        self._fragments = [None] * capacity
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for index in xrange(self._size):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("MessageLog index out of range")
+        pos = self._position(index)
+        return (self._ids[pos], self._messages[pos])
+
+    def _position(self, index):
+        """Returns the position in the buffer of the index-th message """
+        return (self._start + index) % self.capacity
+
+    @property
+    def head_id(self):
+        """Returns the id of the latest message, None if the log is empty """
+        if not self._size:
+            return None
+        return self._ids[self._position(self._size - 1)]
+
+    @property
+    def oldest_id(self):
+        """Returns the id of the oldest message, None if the log is empty """
+        if not self._size:
+            return None
+        return self._ids[self._start]
+
+    def append(self, entry):
+        """Appends a (message_id, message_obj) tuple to the log,
+        dropping the oldest message if the log is full
+        Messages are expected in increasing id order: a message whose
+        id is lower than the head id (i.e. saved concurrently with the
+        head message) is inserted at its place, duplicates are ignored
+
+        """
+        msg_id, message = entry
+        if self._size and msg_id <= self.head_id:
+            self._insert(msg_id, message)
+            return
+        if self._size < self.capacity:
+            pos = self._position(self._size)
+            self._size += 1
+        else:
+            pos = self._start
+            self._drop(self._ids[pos])
+            self._start = (self._start + 1) % self.capacity
+        self._ids[pos] = msg_id
+        self._messages[pos] = message
+        self._fragments[pos] = encode_message(msg_id, message)
+
+    def _insert(self, msg_id, message):
+        """Inserts a message preceding the head message, rebuilding
+        the buffer
+
+        """
+        index = self.bisect(msg_id)
+        if index and self[index - 1][0] == msg_id:
+            return
+        if index == 0 and self._size == self.capacity:
+            self._drop(msg_id)
+            return
+        entries = [(self._ids[pos], self._messages[pos], self._fragments[pos])
+                   for pos in map(self._position, xrange(self._size))]
+        entries.insert(index, (msg_id, message,
+                               encode_message(msg_id, message)))
+        if len(entries) > self.capacity:
+            self._drop(entries.pop(0)[0])
+        self._start = 0
+        self._size = len(entries)
+        for pos, (msg_id, message, fragment) in enumerate(entries):
+            self._ids[pos] = msg_id
+            self._messages[pos] = message
+            self._fragments[pos] = fragment
+
+    def _drop(self, msg_id):
+        """Keeps track of a message dropped from the log """
+        if self.last_dropped_id is None or msg_id > self.last_dropped_id:
+            self.last_dropped_id = msg_id
+
+    def bisect(self, msg_id):
+        """Returns the index of the first message with id greater
+        than msg_id
+
+        """
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._ids[self._position(mid)] <= msg_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def since(self, msg_id):
+        """Returns the MessageBatch of (message_id, message_obj) tuples
+        with message_id greater than msg_id
+
+        """
+        positions = [self._position(index)
+                     for index in xrange(self.bisect(msg_id), self._size)]
+        return MessageBatch(
+            [(self._ids[pos], self._messages[pos]) for pos in positions],
+            [self._fragments[pos] for pos in positions])
+
+    def holds_messages_since(self, msg_id):
+        """Returns True if no message with id greater than msg_id
+        has been dropped from the log
+
+        """
+        return self.last_dropped_id is None or msg_id >= self.last_dropped_id
@@ -0,0 +1,71 @@
+#encoding=utf8
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django_load.core import load_object
+
+
+POLYMORPHIC_MODELS = getattr(settings, 'CHATROOMS_POLYMORPHIC_MODELS', ())
+
+
+class PolymorphicRegistry(object):
+    """
+    Set of the Room and Message subclasses whose instances must be
+    returned as such by the chat queries.
+
+    Chat queries return plain base class rows, skipping the polymorphic
+    resolution of the real class of each row, unless a subclass of the
+    queried model has been registered, by ``register`` or by its full
+    path name in settings.CHATROOMS_POLYMORPHIC_MODELS.
+    Registering the base model itself restores polymorphic resolution
+    for all its queries.
+
+    """
+    def __init__(self, paths=POLYMORPHIC_MODELS):
+        self.paths = list(paths)
+        self.models = set()
+
+    def register(self, model):
+        """Registers a model, can be used as class decorator """
+        self.models.add(model)
+        return model
+
+    def unregister(self, model):
+        """Drops a model from the registry """
+        self.models.discard(model)
+
+    def load_settings_models(self):
+        """Registers the models set in settings, once """
+        while self.paths:
+            path = self.paths.pop()
+            try:
+                self.register(load_object(path))
+            except (ImportError, TypeError) as exc:
+                raise ImproperlyConfigured(
+                    "An error occurred while loading the "
+                    "CHATROOMS_POLYMORPHIC_MODELS: %s" % exc
+                )
+
+    def needs_resolution(self, model):
+        """Returns True if queries of model must return instances
+        of its registered subclasses
+
+        """
+        self.load_settings_models()
+        return any(issubclass(registered, model)
+                   for registered in self.models)
+
+
+polymorphic_registry = PolymorphicRegistry()
+
+register_polymorphic_model = polymorphic_registry.register
+
+
+def read_queryset(queryset):
+    """Returns the queryset returning plain base class rows, unless
+    subclasses of its model have been registered in polymorphic_registry
+
+    """
+    if polymorphic_registry.needs_resolution(queryset.model):
+        return queryset
+    return queryset.non_polymorphic()
@@ -0,0 +1,168 @@
+#encoding=utf8
+import json
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+from .serializers import TIME_FORMAT
+
+
+def encode_user(username, last_seen):
+    """Returns the JSON serializable item of a connected user """
+    return {"username": username,
+            "date": datetime.fromtimestamp(last_seen).strftime(TIME_FORMAT)}
+
+
+class Presence(object):
+    """
+    Connected users of a room, ordered by the time they were last seen,
+    along with a version which counts their changes: users joining,
+    leaving, and users seen again at least granularity seconds after
+    the latest recorded time they were seen, so that refreshes are
+    coalesced. members_version is the version of the latest join or
+    leave.
+
+    Users are moved to the end of the order when they're seen, so that
+    the users not seen for a while are dropped from the start of it
+    (see ``expire``) without walking the whole room.
+
+    The latest log_size changes are logged, so that clients which got
+    a version of the users get only the changes following it (see
+    ``encode_changes``); the encoded list of users and the encoded
+    changes are built once per version.
+
+    """
+    def __init__(self, log_size=1000, granularity=15):
+        # last seen time by username, the least recently seen first
+        self.users = OrderedDict()
+        # last seen time of the users as logged
+        self.recorded = {}
+        self.version = 0
+        self.members_version = 0
+        self.granularity = granularity
+        # (version, username, last seen time, or None if the user left)
+        self.log = deque(maxlen=log_size)
+        # least version the changes following it are all logged
+        self.log_start = 0
+        # (version, JSON encoded list of users)
+        self.encoded = None
+        # JSON encoded changes by version of the client, for self.version
+        self.encoded_changes = {}
+
+    def __contains__(self, username):
+        return username in self.users
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def record(self, username, last_seen):
+        """Logs the change of a user, with the current version """
+        if len(self.log) == self.log.maxlen:
+            self.log_start = self.log[0][0]
+        self.log.append((self.version, username, last_seen))
+        if last_seen is None:
+            self.recorded.pop(username, None)
+        else:
+            self.recorded[username] = last_seen
+
+    def touch(self, username, now=None):
+        """Keeps username among the users, as the latest seen
+        Returns True if the user joined, bumping the version
+
+        """
+        if now is None:
+            now = time.time()
+        joined = self.users.pop(username, None) is None
+        self.users[username] = now
+        if joined:
+            self.version += 1
+            self.members_version = self.version
+            self.record(username, now)
+        elif now - self.recorded[username] >= self.granularity:
+            self.version += 1
+            self.record(username, now)
+        return joined
+
+    def remove(self, username):
+        """Drops username from the users
+        Returns True if the user left, bumping the version
+
+        """
+        if self.users.pop(username, None) is None:
+            return False
+        self.version += 1
+        self.members_version = self.version
+        self.record(username, None)
+        return True
+
+    def expire(self, max_age, now=None):
+        """Drops the users not seen in the latest max_age seconds,
+        bumping the version once
+        Returns the list of the dropped usernames
+
+        """
+        if now is None:
+            now = time.time()
+        deadline = now - max_age
+        expired = []
+        while self.users:
+            username, last_seen = next(self.users.iteritems())
+            if last_seen >= deadline:
+                break
+            del self.users[username]
+            expired.append(username)
+        if expired:
+            self.version += 1
+            self.members_version = self.version
+            for username in expired:
+                self.record(username, None)
+        return expired
+
+    def encode(self):
+        """Returns the JSON encoded list of users, along with the time
+        they were last seen when the list was built: it's built again
+        only when the version changes
+
+        """
+        if self.encoded is None or self.encoded[0] != self.version:
+            self.encoded = (self.version, json.dumps([
+                encode_user(username, last_seen)
+                for username, last_seen in self.users.iteritems()
+            ]))
+        return self.encoded[1]
+
+    def encode_changes(self, version):
+        """
+        Returns the JSON encoded changes following version, as
+        "changed", the users who joined or were seen again along with
+        the time they were seen, and "left", the users who left.
+        Returns None if the changes following version aren't all
+        logged, or if version is greater than the current one.
+
+        """
+        if not self.log_start <= version <= self.version:
+            return None
+        if self.encoded_changes and next(
+                self.encoded_changes.itervalues())[0] != self.version:
+            self.encoded_changes.clear()
+        entry = self.encoded_changes.get(version)
+        if entry is None:
+            changes = OrderedDict()
+            # the latest change of each user is kept
+            for log_version, username, last_seen in reversed(self.log):
+                if log_version <= version:
+                    break
+                changes.setdefault(username, last_seen)
+            entry = (self.version, json.dumps({
+                "changed": [encode_user(username, last_seen)
+                            for username, last_seen in changes.iteritems()
+                            if last_seen is not None],
+                "left": [username
+                         for username, last_seen in changes.iteritems()
+                         if last_seen is None],
+            }))
+            self.encoded_changes[version] = entry
+        return entry[1]
@@ -0,0 +1,101 @@
+#encoding=utf8
+
+from django.conf import settings
+from django.db import connection
+from django.utils.dateparse import parse_datetime
+
+from ..models import Message
+from .messagelog import MessageRecord
+
+
+# whether the database supports window functions, detected if None
+WINDOW_FUNCTIONS = getattr(settings, 'CHATROOMS_WINDOW_FUNCTIONS', None)
+
+
+def supports_window_functions():
+    """Returns True if the database supports the ROW_NUMBER() window
+    function (PostgreSQL, Oracle, MySQL 8, SQLite 3.25 and later),
+    unless settings.CHATROOMS_WINDOW_FUNCTIONS tells otherwise
+
+    """
+    if WINDOW_FUNCTIONS is not None:
+        return WINDOW_FUNCTIONS
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 25)
+    if connection.vendor == 'mysql':
+        return connection.mysql_version >= (8, 0)
+    return connection.vendor in ('postgresql', 'oracle')
+
+
+def get_latest_messages_by_room(room_ids, limit):
+    """
+    Returns a dictionary of lists of the latest limit messages of each
+    room in room_ids, as MessageRecord objects sorted by id.
+
+    Messages of several rooms are read by one windowed query, instead
+    of a query per room, if the database supports window functions
+    (see supports_window_functions).
+
+    """
+    room_ids = list(room_ids)
+    messages = dict((room_id, []) for room_id in room_ids)
+    if not room_ids:
+        return messages
+    if len(room_ids) == 1 or not supports_window_functions():
+        for room_id in room_ids:
+            messages[room_id] = get_messages_page(room_id, limit=limit)[0]
+        return messages
+    qn = connection.ops.quote_name
+    query = (
+        "SELECT id, room_id, username, date, content FROM ("
+        "SELECT %(id)s AS id, %(room)s AS room_id, %(username)s AS username,"
+        " %(date)s AS date, %(content)s AS content, ROW_NUMBER() OVER ("
+        "PARTITION BY %(room)s ORDER BY %(id)s DESC) AS rn"
+        " FROM %(table)s WHERE %(room)s IN (%(room_ids)s)"
+        ") latest WHERE rn <= %%s ORDER BY room_id, id" % {
+            'id': qn('id'),
+            'room': qn('room_id'),
+            'username': qn('username'),
+            'date': qn('date'),
+            'content': qn('content'),
+            'table': qn(Message._meta.db_table),
+            'room_ids': ', '.join(['%s'] * len(room_ids)),
+        })
+    cursor = connection.cursor()
+    cursor.execute(query, room_ids + [limit])
+    for msg_id, room_id, username, date, content in cursor.fetchall():
+        if not hasattr(date, 'strftime'):
+            date = parse_datetime(date)
+        messages[room_id].append(
+            MessageRecord(msg_id, username, date, content))
+    return messages
+
+
+def get_messages_page(room_id, before_id=None, after_id=None, limit=50):
+    """
+    Returns a tuple (records, has_more), where records is a list of
+    at most limit messages of a room as MessageRecord objects sorted
+    by id: the ones following after_id if given, else the ones
+    preceding before_id if given, else the latest ones.
+    has_more tells whether further messages exist beyond the page,
+    in the same direction.
+
+    Pages are read by keyset pagination over the (room, id) index of
+    messages, so reading a page costs the same at any depth of history,
+    unlike OFFSET pagination.
+
+    """
+    queryset = Message.objects.filter(room=room_id)
+    if after_id is not None:
+        queryset = queryset.filter(pk__gt=after_id).order_by('pk')
+    else:
+        if before_id is not None:
+            queryset = queryset.filter(pk__lt=before_id)
+        queryset = queryset.order_by('-pk')
+    rows = list(queryset.values_list(
+                    'id', 'username', 'date', 'content')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is None:
+        rows.reverse()
+    return [MessageRecord(*fields) for fields in rows], has_more
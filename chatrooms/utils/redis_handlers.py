@@ -1,33 +1,133 @@
 #encoding=utf8
 import redis
+import gevent
 
-from django.db.models import Max
+from django.conf import settings
 
 from .handlers import MessageHandler
-from ..models import Room, Message
+from .messagelog import EncodedMessage, MessageBatch, MessageRecord
+from .queries import get_latest_messages_by_room
+from .rooms import room_cache
+from .serializers import encode_message
+from ..models import Message
+
+
+REDIS_URL = getattr(settings, 'CHATROOMS_REDIS_URL',
+                    'redis://localhost:6379/0')
+
+REDIS_WAIT_TIMEOUT = getattr(settings, 'CHATROOMS_REDIS_WAIT_TIMEOUT', 20)
+
+REDIS_MESSAGES_SIZE = getattr(settings, 'CHATROOMS_REDIS_MESSAGES_SIZE', 50)
+
+CHANNEL_PREFIX = 'chatrooms:room:'
 
 
 class RedisMessageHandler(MessageHandler):
     """Custom MessageHandler class using redis
     for synchronization
+
+    Messages are published to a channel per room.
+    A single subscriber greenlet per process listens to the rooms channels
+    and wakes up the requests waiting on the ChatView room events,
+    so that redis connections don't grow with the number of requests.
+
+    The latest messages of each room (settings.CHATROOMS_REDIS_MESSAGES_SIZE)
+    are stored as JSON fragments in a sorted set scored by message id,
+    along with the id of the latest message: requests are answered
+    from redis, and db is read only for messages older than the ones
+    kept by redis.
     """
-    def __init__(self):
-        """Initializes redis connection
+    def __init__(self, client=None):
+        """Initializes the redis client, sharing a pool of connections
+        """
+        if client is None:
+            client = redis.Redis(
+                        connection_pool=redis.ConnectionPool.from_url(
+                            REDIS_URL))
+        self.client = client
+        self.subscriber = None
+
+    def get_channel(self, room_id):
+        """Returns the name of the redis channel of a room """
+        return '%s%s' % (CHANNEL_PREFIX, room_id)
+
+    def get_messages_key(self, room_id):
+        """Returns the key of the sorted set of the latest messages """
+        return '%s%s:messages' % (CHANNEL_PREFIX, room_id)
+
+    def get_head_key(self, room_id):
+        """Returns the key of the id of the latest message """
+        return '%s%s:head' % (CHANNEL_PREFIX, room_id)
+
+    def store_messages(self, room_id, messages):
+        """Adds (message_id, message_obj) tuples to the latest messages
+        of a room, keeping the greatest id as the latest message id
+
         """
-        self.client = redis.Redis()
-        self.pubsub = self.client.pubsub()
+        messages_key = self.get_messages_key(room_id)
+        head_key = self.get_head_key(room_id)
+        fragments = dict((encode_message(msg_id, message), msg_id)
+                         for msg_id, message in messages)
+        head_id = max(fragments.values() or [-1])
+
+        def store(pipe):
+            current_head_id = pipe.get(head_key)
+            pipe.multi()
+            if fragments:
+                pipe.zadd(messages_key, fragments)
+                pipe.zremrangebyrank(
+                    messages_key, 0, -(REDIS_MESSAGES_SIZE + 1))
+            if current_head_id is None or int(current_head_id) < head_id:
+                pipe.set(head_key, head_id)
+        self.client.transaction(store, head_key)
+
+    def load_room(self, room_id):
+        """Stores in redis the latest messages of a room read from db """
+        records = get_latest_messages_by_room(
+                        [room_id], REDIS_MESSAGES_SIZE)[room_id]
+        self.store_messages(
+            room_id, [(record.id, record) for record in records])
+
+    def start_subscriber(self, chatobj):
+        """Spawns the subscriber greenlet, unless it's running """
+        if self.subscriber is None or self.subscriber.dead:
+            self.subscriber = gevent.spawn(self.listen, chatobj)
+
+    def listen(self, chatobj):
+        """
+        Listens to the rooms channels and signals new_message_event
+        on chatobj for each message published to a room channel.
+        On connection errors, wakes up all the waiting requests,
+        which might have missed a message, and subscribes again.
+
+        """
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe('%s*' % CHANNEL_PREFIX)
+                while True:
+                    item = pubsub.get_message(timeout=REDIS_WAIT_TIMEOUT)
+                    if item is None:
+                        continue
+                    room_id = int(item['channel'][len(CHANNEL_PREFIX):])
+                    chatobj.signal_new_message_event(room_id)
+            except redis.ConnectionError:
+                for room_id in chatobj.new_message_events.keys():
+                    chatobj.signal_new_message_event(room_id)
+                gevent.sleep(1)
 
     def handle_received_message(self,
         sender, room_id, username, message, date, **kwargs):
         """
         1. saves the message
-        2. publish a message to the redis client
+        2. stores the message among the latest room messages in redis
+        3. publish the message id to the room channel
 
         """
 
-        room = Room.objects.get(id=room_id)
+        room = room_cache.get(pk=room_id)
         fields = {
-            'room': room,
+            'room_id': room.id,
             'date': date,
             'content': message,
             'username': username,
@@ -40,29 +140,73 @@ class RedisMessageHandler(MessageHandler):
         new_message.save()
 
         # 2
-        self.client.publish('chatrooms', 'new message')
+        if self.client.exists(self.get_head_key(room_id)):
+            self.store_messages(room_id, [(new_message.pk, new_message)])
+        else:
+            self.load_room(room_id)
+
+        # 3
+        self.client.publish(self.get_channel(room_id), new_message.pk)
 
     def retrieve_messages(self, chatobj, room_id, latest_msg_id, **kwargs):
         """
-        1. waits for "new message" on redis
-        2. returns the list of latest messages
+        1. waits for a message on the room channel, at most the
+        timeout given by keyword or settings.CHATROOMS_REDIS_WAIT_TIMEOUT
+        seconds, unless the room already received messages following
+        latest_msg_id
+        2. returns the messages following latest_msg_id stored in redis,
+        reading from db the ones older than the messages kept by redis
 
         """
-        client = redis.Redis(socket_timeout=20)
-        pubsub = client.pubsub()
-        pubsub.subscribe('chatrooms')
+        self.start_subscriber(chatobj)
         # 1
-        msg = pubsub.listen().next()  # TODO: timeout?
-        pubsub.unsubscribe('chatrooms')
+        chatobj.wait_for_new_message(
+            room_id, latest_msg_id,
+            timeout=kwargs.get('timeout', REDIS_WAIT_TIMEOUT))
         # 2
-        messages = Message.objects.filter(room=room_id, id__gt=latest_msg_id)
-        return [(msg.pk, msg) for msg in messages]
+        messages_key = self.get_messages_key(room_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zrangebyscore(
+            messages_key, '(%d' % latest_msg_id, '+inf', withscores=True)
+        pipe.zcard(messages_key)
+        pipe.zrange(messages_key, 0, 0, withscores=True)
+        stored, count, oldest = pipe.execute()
+        messages = MessageBatch(
+            [(int(msg_id), EncodedMessage(fragment))
+             for fragment, msg_id in stored],
+            [fragment for fragment, msg_id in stored])
+        if count >= REDIS_MESSAGES_SIZE and oldest[0][1] > latest_msg_id:
+            oldest_id = int(oldest[0][1])
+            dropped = MessageBatch(
+                (fields[0], MessageRecord(*fields))
+                for fields in Message.objects.filter(
+                    room=room_id, pk__gt=latest_msg_id, pk__lt=oldest_id,
+                ).order_by('pk').values_list(
+                    'id', 'username', 'date', 'content',
+                )[:REDIS_MESSAGES_SIZE])
+            if len(dropped) == REDIS_MESSAGES_SIZE:
+                return dropped
+            dropped.extend(messages)
+            messages = dropped
+        return messages
+
+    def load_latest_messages(self, chatobj, room_ids):
+        """Messages are read from redis on each request, and from db
+        when they're older than the ones kept by redis: rooms messages
+        queues aren't used
+
+        """
+        pass
 
     def get_latest_message_id(self, chatobj, room_id):
-        """Returns id of the latest message received """
-        latest_msg_id = Message.objects.filter(
-                        room=room_id).aggregate(
-                        max_id=Max('id')).get('max_id')
-        if not latest_msg_id:
-            latest_msg_id = -1
-        return latest_msg_id
+        """Returns id of the latest message received, loading the room
+        latest messages from db if redis doesn't hold them yet
+
+        """
+        self.start_subscriber(chatobj)
+        head_key = self.get_head_key(room_id)
+        latest_msg_id = self.client.get(head_key)
+        if latest_msg_id is None:
+            self.load_room(room_id)
+            latest_msg_id = self.client.get(head_key)
+        return int(latest_msg_id)
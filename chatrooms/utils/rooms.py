@@ -0,0 +1,127 @@
+#encoding=utf8
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import Http404
+
+from ..models import Room
+
+
+# seconds, None means entries never expire
+ROOM_CACHE_TTL = getattr(settings, 'CHATROOMS_ROOM_CACHE_TTL', 60)
+
+
+class RoomInfo(object):
+    """
+    Immutable copy of the fields of a Room which are checked on each
+    request: cached instead of Room instances, which carry their state
+    and polymorphic attributes.
+
+    """
+    __slots__ = ('id', 'slug', 'name', 'allow_anonymous_access', 'private')
+
+    def __init__(self, id, slug, name, allow_anonymous_access, private):
+        for name_, value in zip(self.__slots__,
+                                (id, slug, name,
+                                 allow_anonymous_access, private)):
+            object.__setattr__(self, name_, value)
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RoomInfo objects are immutable")
+
+    def __repr__(self):
+        return '<RoomInfo %s: %s>' % (self.id, self.slug)
+
+
+class RoomCache(object):
+    """
+    Process-local cache of RoomInfo objects, looked up by room id
+    or by slug.
+
+    Entries are dropped when their room is saved or deleted.
+    Rooms changed by other processes are read again once their entries
+    are older than ttl seconds (settings.CHATROOMS_ROOM_CACHE_TTL,
+    60 by default); entries never expire if ttl is None, as processes
+    then miss the changes of the other ones.
+
+    """
+    def __init__(self, ttl=ROOM_CACHE_TTL):
+        self.ttl = ttl
+        # (room_info, expiry time) tuples
+        self.by_id = {}
+        self.by_slug = {}
+
+    def get(self, pk=None, slug=None):
+        """
+        Returns the RoomInfo of the room with the given pk or slug,
+        reading it from db if it isn't cached or it's expired.
+        Raises Room.DoesNotExist like Room.objects.get
+
+        """
+        if pk is not None:
+            cache, key, lookup = self.by_id, int(pk), {'pk': pk}
+        else:
+            cache, key, lookup = self.by_slug, slug, {'slug': slug}
+        entry = cache.get(key)
+        if entry is not None and (entry[1] is None or entry[1] > time.time()):
+            return entry[0]
+        info = RoomInfo(*Room.objects.values_list(
+                                *RoomInfo.__slots__).get(**lookup))
+        self.store(info)
+        return info
+
+    def store(self, info):
+        """Caches a RoomInfo by its id and slug """
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        self.by_id[info.id] = (info, expires)
+        self.by_slug[info.slug] = (info, expires)
+
+    def invalidate(self, room):
+        """Drops the cached entries of a room """
+        entry = self.by_id.pop(room.pk, None)
+        slugs = set([room.slug])
+        if entry is not None:
+            slugs.add(entry[0].slug)
+        for slug in slugs:
+            entry = self.by_slug.get(slug)
+            if entry is not None and entry[0].id == room.pk:
+                del self.by_slug[slug]
+
+    def clear(self):
+        """Drops all the cached entries """
+        self.by_id.clear()
+        self.by_slug.clear()
+
+
+room_cache = RoomCache()
+
+
+def get_room_or_404(**kwargs):
+    """Returns the cached RoomInfo of a room looked up by pk or slug,
+    raises Http404 if the room doesn't exist
+
+    """
+    try:
+        return room_cache.get(**kwargs)
+    except (Room.DoesNotExist, ValueError):
+        raise Http404("No room matches the given query.")
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_cached_room(sender, **kwargs):
+    """Drops the cached entries of a room when it's saved or deleted.
+    Senders aren't filtered, so that Room subclasses are handled too
+
+    """
+    instance = kwargs.get('instance')
+    if isinstance(instance, Room):
+        room_cache.invalidate(instance)
@@ -0,0 +1,37 @@
+#encoding=utf8
+
+import json
+
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S:%f'
+
+
+def serialize_message(msg_id, message):
+    """Returns the dictionary sent to clients for a chat message """
+    return {"message_id": msg_id,
+            "username": message.username,
+            "date": message.date.strftime(TIME_FORMAT),
+            "content": message.content}
+
+
+def encode_message(msg_id, message):
+    """Returns the JSON fragment sent to clients for a chat message """
+    return json.dumps(serialize_message(msg_id, message))
+
+
+def encode_messages(messages, latest_msg_id=None):
+    """
+    Returns the JSON encoded list of messages with id greater than
+    latest_msg_id, given a list of (message_id, message_obj) tuples.
+
+    Pre-encoded fragments are joined as they are when messages carry
+    them (see utils.messagelog.MessageBatch), so that each message
+    is serialized once, instead of once per request.
+
+    """
+    fragments = getattr(messages, 'fragments', None)
+    if fragments is None:
+        fragments = [encode_message(msg_id, message)
+                     for msg_id, message in messages
+                     if latest_msg_id is None or msg_id > latest_msg_id]
+    return '[%s]' % ', '.join(fragments)
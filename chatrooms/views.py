@@ -5,6 +5,7 @@ from django.http import HttpResponseRedirect
 from django.views.generic import ListView, DetailView, FormView
 
 from .utils.auth import get_login_url
+from .utils.polymorphism import read_queryset
 from .forms.guest import GuestNameForm
 from .models import Room
 
@@ -19,7 +20,7 @@ class RoomsListView(ListView):
         filters = {}
         if self.request.user.is_anonymous():
             filters['allow_anonymous_access'] = True
-        return Room.objects.filter(**filters)
+        return read_queryset(Room.objects.filter(**filters))
 
 
 class RoomView(DetailView):
@@ -28,6 +29,9 @@ class RoomView(DetailView):
     context_object_name = 'room'
     template_name = "chatrooms/room.html"
 
+    def get_queryset(self):
+        return read_queryset(super(RoomView, self).get_queryset())
+
 
 class GuestNameView(FormView):
     """Shows the form to choose a guest name to anonymous users """